@@ -1,17 +1,29 @@
 import streamlit as st
 import google.generativeai as genai
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
 from datetime import datetime
-from PIL import Image
 import os
+import io
+import json
 import time
-import pandas as pd
 import threading
+from collections import OrderedDict, deque
+from contextlib import contextmanager
 import queue
+import atexit
+import random
+import re
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, Future
+import chat_store
+from context_cache import ContextCache, KB_CONTEXT_NOTE
+# pandas, PIL, gspread and oauth2client are imported where they are used, so reruns (and cold starts that
+# never touch them) don't pay for them
+
+RERUN_STARTED = time.perf_counter()
 
 # --- 1. CONFIGURATION ---
 st.set_page_config(page_title="Beverage Innovator 3.0", layout="wide", initial_sidebar_state="expanded")
+RERUN_BUDGET_MS = int(st.secrets.get("RERUN_BUDGET_MS", 150))  # target for reruns that don't call the model (clicks, navigation)
 
 # --- 2. CSS STYLING (CLEAN UI + MOBILE FIXES) ---
 st.markdown("""
@@ -104,8 +116,10 @@ def check_password():
     st.markdown("<h1>🔒 J'son 3.0</h1>", unsafe_allow_html=True) 
     password = st.text_input("Enter Password", type="password")
     if st.button("Login"): 
-        if password == st.secrets["APP_PASSWORD"]:
+        admin_password = st.secrets.get("ADMIN_PASSWORD")
+        if password == st.secrets["APP_PASSWORD"] or (admin_password and password == admin_password):
             st.session_state["password_correct"] = True
+            st.session_state["is_admin"] = bool(admin_password) and password == admin_password
             st.rerun()
         else:
             st.error("❌ Incorrect Password")
@@ -118,113 +132,751 @@ if not check_password():
 #  ✅ APP LOGIC STARTS HERE
 # ==========================================
 
+# --- ⚡ API GUARD (RATE LIMITS + RETRIES) ---
+# Every Gemini and Sheets call goes through one process-wide ApiGuard: a token bucket per API,
+# jittered exponential backoff on 429/5xx (honouring the server's retry-after), and coalescing of
+# identical in-flight calls. Its counters show up in the sidebar.
+def _error_status(e):
+    """HTTP status of a gspread (e.response.status_code) or google.api_core (e.code) error, if any."""
+    status = getattr(getattr(e, "response", None), "status_code", None)
+    if status is None: status = getattr(e, "code", None)
+    try: return int(status) if status is not None else None
+    except (TypeError, ValueError): return None
+
+def _is_retryable(e):
+    status = _error_status(e)
+    if status is not None: return status == 429 or status >= 500
+    # Network failures only: other OSErrors (a missing file, a permission error) won't go away by waiting
+    if isinstance(e, (ConnectionError, TimeoutError)): return True
+    try: import requests  # gspread's transport; its errors don't subclass the builtin ones
+    except ImportError: return False
+    return isinstance(e, (requests.ConnectionError, requests.Timeout))
+
+def _retry_after(e):
+    """Seconds the server asked us to wait, from a Retry-After header, RetryInfo details, or "retry in 12.3s" text."""
+    headers = getattr(getattr(e, "response", None), "headers", None) or {}
+    try: return float(headers.get("Retry-After"))
+    except (TypeError, ValueError): pass
+    for detail in getattr(e, "details", None) or []:
+        delay = getattr(detail, "retry_delay", None)
+        if delay is not None: return delay.seconds + delay.nanos / 1e9
+    m = re.search(r"retry in ([\d.]+)\s*s", str(e), re.IGNORECASE)
+    return float(m.group(1)) if m else None
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate, self.capacity = rate, capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a token is available. Returns the seconds spent waiting."""
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+class ApiGuard:
+    def __init__(self, limits, max_retries=5, base_delay=1.0, max_delay=32.0):
+        self.buckets = {api: TokenBucket(rate, burst) for api, (rate, burst) in limits.items()}
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.lock = threading.Lock()
+        self.counters = {}
+        self._inflight = {}
+
+    def _count(self, api, name):
+        with self.lock: self.counters[(api, name)] = self.counters.get((api, name), 0) + 1
+
+    def snapshot(self):
+        """{api: {"calls", "retries", "throttled", "failures", "coalesced"}}"""
+        with self.lock: items = list(self.counters.items())
+        out = {}
+        for (api, name), n in items: out.setdefault(api, {"calls": 0, "retries": 0, "throttled": 0, "failures": 0, "coalesced": 0})[name] = n
+        return out
+
+    def totals(self):
+        totals = {"retries": 0, "throttled": 0, "failures": 0}
+        for counts in self.snapshot().values():
+            for name in totals: totals[name] += counts[name]
+        return totals
+
+    def call(self, api, fn, *args, key=None, max_retries=None, **kwargs):
+        """fn(*args, **kwargs) under the API's rate limit and retry policy. Calls with the same key share one request.
+        max_retries overrides the guard's default for calls that have a cheap fallback."""
+        retries = self.max_retries if max_retries is None else max_retries
+        if key is None: return self._call(api, fn, args, kwargs, retries)
+        with self.lock:
+            future = self._inflight.get((api, key))
+            leader = future is None
+            if leader: future = self._inflight[(api, key)] = Future()
+        if not leader:
+            self._count(api, "coalesced")
+            return future.result()
+        try:
+            result = self._call(api, fn, args, kwargs, retries)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock: self._inflight.pop((api, key), None)
+
+    def _call(self, api, fn, args, kwargs, retries):
+        bucket = self.buckets.get(api)
+        for attempt in range(retries + 1):
+            if bucket and bucket.acquire() > 0: self._count(api, "throttled")
+            self._count(api, "calls")
+            try: return fn(*args, **kwargs)
+            except Exception as e:
+                if not _is_retryable(e) or attempt == retries:
+                    self._count(api, "failures")
+                    raise
+                self._count(api, "retries")
+                backoff = min(self.base_delay * 2 ** attempt, self.max_delay)
+                time.sleep(max(_retry_after(e) or 0, backoff * random.uniform(0.5, 1.5)))
+
+@st.cache_resource
+def get_api_guard():
+    # (requests per second, burst). Sheets allows ~60 requests/min per user; tune Gemini to your tier.
+    return ApiGuard({
+        "sheets": (float(st.secrets.get("SHEETS_RPS", 1.0)), 10),
+        "gemini": (float(st.secrets.get("GEMINI_RPS", 2.0)), 10),
+    })
+
+# --- ⚡ METRICS (TIMING SPANS) ---
+# Stages of a turn are timed with metrics.span() / metrics.record(). Each span is appended to a size-rotated
+# JSONL file and kept in a per-stage window for p50/p95; a Prometheus text snapshot (textfile-collector
+# format) is rewritten next to it every few seconds. Admins see the numbers in the sidebar.
+METRICS_PATH = st.secrets.get("METRICS_PATH", "metrics.jsonl")
+METRICS_MAX_BYTES = 5 * 1024 * 1024
+METRICS_BACKUPS = 3
+METRICS_WINDOW = 500
+
+def _percentile(sorted_values, q):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * q))] if sorted_values else 0.0
+
+class Metrics:
+    def __init__(self, path=METRICS_PATH, max_bytes=METRICS_MAX_BYTES, backups=METRICS_BACKUPS, window=METRICS_WINDOW, snapshot_every=10.0):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.window = window
+        self.snapshot_every = snapshot_every
+        self.lock = threading.Lock()
+        self.samples, self.counts, self.sums = {}, {}, {}
+        self.sources = {}
+        self._last_snapshot = 0.0
+
+    def register(self, name, fn):
+        """fn() -> {metric: number}; exported as app_<name>_<metric> in the Prometheus snapshot."""
+        self.sources[name] = fn
+
+    def record(self, stage, ms, **fields):
+        line = json.dumps({"ts": round(time.time(), 3), "stage": stage, "ms": round(ms, 2), **fields}, default=str)
+        with self.lock:
+            self.samples.setdefault(stage, deque(maxlen=self.window)).append(ms)
+            self.counts[stage] = self.counts.get(stage, 0) + 1
+            self.sums[stage] = self.sums.get(stage, 0.0) + ms
+            try:
+                if os.path.exists(self.path) and os.path.getsize(self.path) > self.max_bytes: self._rotate()
+                with open(self.path, "a", encoding="utf-8") as f: f.write(line + "\n")
+            except OSError: pass
+            due = time.monotonic() - self._last_snapshot > self.snapshot_every
+            if due: self._last_snapshot = time.monotonic()
+        if due: self.write_snapshot()
+
+    @contextmanager
+    def span(self, stage, **fields):
+        """Times the block. Yields the fields dict so the block can add details (sizes, outcomes)."""
+        started = time.perf_counter()
+        try: yield fields
+        finally: self.record(stage, (time.perf_counter() - started) * 1000, **fields)
+
+    def _rotate(self):
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"): os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        os.replace(self.path, f"{self.path}.1")
+
+    def summary(self):
+        """{stage: {"count", "p50", "p95"}} over the last `window` samples of each stage."""
+        with self.lock: items = [(stage, sorted(values), self.counts[stage]) for stage, values in self.samples.items()]
+        return {stage: {"count": count, "p50": _percentile(values, 0.5), "p95": _percentile(values, 0.95)} for stage, values, count in sorted(items)}
+
+    def prometheus(self):
+        lines = ["# HELP app_stage_ms Latency of each stage of a turn, in milliseconds.", "# TYPE app_stage_ms summary"]
+        with self.lock: items = [(stage, sorted(values), self.counts[stage], self.sums[stage]) for stage, values in self.samples.items()]
+        for stage, values, count, total in sorted(items):
+            for q in (0.5, 0.95): lines.append(f'app_stage_ms{{stage="{stage}",quantile="{q}"}} {_percentile(values, q):.3f}')
+            lines.append(f'app_stage_ms_sum{{stage="{stage}"}} {total:.3f}')
+            lines.append(f'app_stage_ms_count{{stage="{stage}"}} {count}')
+        for name, fn in list(self.sources.items()):
+            try: values = fn()
+            except Exception: continue
+            for key, value in sorted(values.items()):
+                if isinstance(value, (int, float)) and not isinstance(value, bool): lines.append(f"app_{name}_{key} {value}")
+        return "\n".join(lines) + "\n"
+
+    def write_snapshot(self):
+        path = os.path.splitext(self.path)[0] + ".prom"
+        try:
+            with open(path + ".tmp", "w", encoding="utf-8") as f: f.write(self.prometheus())
+            os.replace(path + ".tmp", path)
+        except OSError: pass
+
+@st.cache_resource
+def get_metrics():
+    metrics = Metrics()
+    guard = get_api_guard()
+    metrics.register("api", lambda: {f"{api}_{name}": n for api, counts in guard.snapshot().items() for name, n in counts.items()})
+    return metrics
+
 # --- 4. OPTIMIZED DATABASE CONNECTION ---
+LOG_ROTATE_ROWS = int(st.secrets.get("LOG_ROTATE_ROWS", chat_store.LOG_ROTATE_ROWS))
+LOG_ROTATE_DAYS = int(st.secrets.get("LOG_ROTATE_DAYS", chat_store.LOG_ROTATE_DAYS))
+
 @st.cache_resource
 def connect_to_db():
+    backend = st.secrets.get("STORAGE_BACKEND", "sheets")
+    if backend == "sqlite":
+        return chat_store.SQLiteStore(st.secrets.get("SQLITE_PATH", "chat_logs.db"))
     try:
         if "gcp_service_account" in st.secrets:
+            import gspread
+            from oauth2client.service_account import ServiceAccountCredentials
             scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
             creds = ServiceAccountCredentials.from_json_keyfile_dict(dict(st.secrets["gcp_service_account"]), scope)
             client = gspread.authorize(creds)
-            return client.open("JSON 3.0 Logs").sheet1
+            return chat_store.SheetStore(client.open("JSON 3.0 Logs").sheet1, get_api_guard(), LOG_ROTATE_ROWS, LOG_ROTATE_DAYS)
     except: return None
 
-sheet = connect_to_db()
+store = connect_to_db()
+
+# --- ⚡ BACKGROUND SAVE (BATCHED WRITE-BEHIND QUEUE) ---
+class LogWriter:
+    """One writer per process: rows go into a bounded queue and are flushed with a single append_rows per window."""
+    def __init__(self, store, metrics=None, max_queue=5000, max_batch=500, flush_interval=1.0, retry_pause=30.0):
+        self.store = store
+        self.metrics = metrics
+        self.q = queue.Queue(maxsize=max_queue)
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.retry_pause = retry_pause
+        self.stats = {"written": 0, "dropped": 0, "retries": 0, "batches": 0, "last_error": None}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._flush_now = threading.Event()
+        self._paused = threading.Event()  # set while backing off after a quota error
+        self._failures = 0
+        self._batch = []
+        self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def enqueue(self, row, timeout=2.0):
+        try:
+            self.q.put(row, timeout=timeout)
+            return True
+        except queue.Full:
+            self._count("dropped", 1)
+            return False
+
+    def depth(self):
+        return self.q.unfinished_tasks
+
+    def pending(self, session_id):
+        """Rows of `session_id` not written yet (the batch in hand, then the queue), in order."""
+        with self.q.mutex: rows = list(self._batch) + list(self.q.queue)
+        return [row for row in rows if row[1] == session_id]
+
+    def flush(self, timeout=10.0):
+        """Waits until the queue is written. Returns False at once while the writer is backing off from a quota error."""
+        if self._paused.is_set(): return False
+        self._flush_now.set()
+        with self.q.all_tasks_done:
+            return self.q.all_tasks_done.wait_for(lambda: self.q.unfinished_tasks == 0, timeout)
+
+    def close(self, timeout=15.0):
+        if self._stop.is_set(): return
+        self._stop.set()
+        self._thread.join(timeout)
+
+    def _count(self, key, n):
+        with self._lock: self.stats[key] += n
+
+    def _run(self):
+        batch = self._batch
+        while not (self._stop.is_set() and not batch and self.q.empty()):
+            # Collect rows for one flush window (or until the batch is full)
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.max_batch:
+                wait = 0 if (self._stop.is_set() or self._flush_now.is_set()) else deadline - time.monotonic()
+                try: row = self.q.get(timeout=wait) if wait > 0 else self.q.get_nowait()
+                except queue.Empty: break
+                with self.q.mutex: batch.append(row)
+            if not batch: self._flush_now.clear()
+            elif not self._write(batch):
+                with self.q.mutex: batch.clear()
+
+    def _write(self, batch):
+        """Returns True if the batch still needs writing (kept in order for the next window).
+
+        Backoff happens here rather than in the ApiGuard: the store doesn't retry the write, so it never holds its
+        lock (which every read takes) while waiting out a quota error.
+        """
+        started = time.perf_counter()
+        try:
+            self.store.append_rows(batch, retries=0)
+            self._failures = 0
+            if self.metrics: self.metrics.record("sheet_write", (time.perf_counter() - started) * 1000, rows=len(batch))
+            self._count("written", len(batch)); self._count("batches", 1)
+            for _ in batch: self.q.task_done()
+            return False
+        except Exception as e:
+            self.stats["last_error"] = f"{type(e).__name__}: {e}"
+            if self.metrics: self.metrics.record("sheet_write", (time.perf_counter() - started) * 1000, rows=len(batch), error=type(e).__name__)
+            if _is_retryable(e) and not self._stop.is_set():
+                self._count("retries", 1)
+                self._failures += 1
+                pause = min(max(_retry_after(e) or 0, 2 ** self._failures * random.uniform(0.5, 1.5)), self.retry_pause)
+                self._paused.set()
+                try: self._stop.wait(pause)
+                finally: self._paused.clear()
+                return True  # keep the rows, try again next window
+        self._count("dropped", len(batch))
+        for _ in batch: self.q.task_done()
+        return False
+
+@st.cache_resource
+def get_log_writer():
+    if not store: return None
+    metrics = get_metrics()
+    writer = LogWriter(store, metrics)
+    metrics.register("log_writer", lambda: {**writer.stats, "queue_depth": writer.depth()})
+    return writer
+
+def save_to_sheet_background(session_id, role, content):
+    writer = get_log_writer()
+    if writer:
+        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        writer.enqueue([timestamp, session_id, role, content])
+
+# --- ⚡ ARCHIVE COMPACTION (BACKGROUND) ---
+# Log rotation runs on the writer thread, so compaction (rewriting archives that hold deleted rows, indexing
+# archives a half-finished rotation left behind) runs here every LOG_COMPACT_HOURS, or from the admin button.
+LOG_COMPACT_HOURS = float(st.secrets.get("LOG_COMPACT_HOURS", 24))
+
+def _compact_loop(store, metrics, interval):
+    while True:
+        time.sleep(interval)
+        try:
+            with metrics.span("compact") as fields: fields["reclaimed"] = store.compact()
+        except Exception: pass  # the span is still recorded; the next run tries again
+
+@st.cache_resource
+def start_log_compactor():
+    if not store or LOG_COMPACT_HOURS <= 0: return None
+    thread = threading.Thread(target=_compact_loop, args=(store, get_metrics(), LOG_COMPACT_HOURS * 3600), name="log-compactor", daemon=True)
+    thread.start()
+    return thread
+
+start_log_compactor()
+
+@st.cache_resource
+def configure_genai(api_key):
+    genai.configure(api_key=api_key)
+
+@st.cache_resource
+def get_model(name, system_instruction=None):
+    """One GenerativeModel per (name, system prompt) per process instead of one per rerun or call."""
+    return genai.GenerativeModel(name, system_instruction=system_instruction)
 
 if "GEMINI_API_KEY" in st.secrets:
-    genai.configure(api_key=st.secrets["GEMINI_API_KEY"])
+    configure_genai(st.secrets["GEMINI_API_KEY"])
 
 # --- 5. INITIALIZE SESSION STATE ---
 if "uploader_key" not in st.session_state:
     st.session_state.uploader_key = 0
 
 # --- 6. SMART TITLE GENERATOR (GLOBAL SCOPE) ---
-def get_smart_title(user_text):
-    try:
-        model = genai.GenerativeModel("gemini-1.5-flash") 
-        response = model.generate_content(f"Generate a 3-4 word title. No quotes. Input: {user_text}")
-        return response.text.strip().replace('"', '').replace("Title:", "")
-    except:
-        return (user_text[:25] + "..") if len(user_text) > 25 else user_text
+TITLE_WORKERS = 4
+TITLE_MODEL = "gemini-1.5-flash"
+# Worker threads have no script context, so the cached model and API guard are looked up before they start
+# and passed in (here and in the KB loader and the response stream)
+
+def _generate_title(model, guard, user_text):
+    # No retries: a failed title falls back to the truncated text right away and is retried on the next load
+    response = guard.call("gemini", model.generate_content, f"Generate a 3-4 word title. No quotes. Input: {user_text}",
+                                    key=("title", user_text), max_retries=0)
+    return response.text.strip().replace('"', '').replace("Title:", "")
+
+def _fallback_title(user_text):
+    return (user_text[:25] + "..") if len(user_text) > 25 else user_text
+
+def _title_hash(user_text):
+    return hashlib.sha1(user_text.encode("utf-8")).hexdigest()[:16]
+
+def resolve_titles(first_msgs, stored=None):
+    """{sid: first user message} -> {sid: title}. Stored titles ({sid: (hash, title)}, loaded if not given) are reused
+    while their hash still matches; only missing or stale ones hit the model, a few at a time."""
+    if stored is None:
+        try: stored = store.load_titles() if store else {}
+        except: stored = {}
+    titles, missing = {}, {}
+    for sid, text in first_msgs.items():
+        cached = stored.get(sid)
+        if cached and cached[0] == _title_hash(text): titles[sid] = cached[1]
+        else: missing[sid] = text
+    if not missing: return titles
+
+    try: model, guard = get_model(TITLE_MODEL), get_api_guard()
+    except Exception: model = guard = None
+
+    def attempt(text):
+        try: return _generate_title(model, guard, text), True
+        except: return _fallback_title(text), False
+
+    with get_metrics().span("title_generation", titles=len(missing)), ThreadPoolExecutor(max_workers=TITLE_WORKERS) as pool:
+        results = dict(zip(missing, pool.map(attempt, missing.values())))
+    titles.update({sid: title for sid, (title, _) in results.items()})
+    # Only persist real titles, so a failed call is retried on the next load
+    fresh = [(sid, _title_hash(missing[sid]), title) for sid, (title, ok) in results.items() if ok]
+    if store and fresh:
+        try: store.save_titles(fresh)
+        except: pass
+    return titles
+
+# --- 7. HISTORY LOADER (SHARED CACHE + DELTA SYNC) ---
+# One history cache per process, shared by every browser session. It holds the session index
+# (id -> last updated / message count), titles, and an LRU of message bodies fetched on demand.
+# Per-user state only keeps session IDs: the active one and any empty chats not saved yet.
+HISTORY_CACHE_SIZE = 64
+
+def _session_num(sid):
+    try: return int(sid.replace("Session ", ""))
+    except: return 0
+
+def _now():
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+class HistoryCache:
+    def __init__(self, store, writer, max_bodies=HISTORY_CACHE_SIZE):
+        self.store = store
+        self.writer = writer
+        self.max_bodies = max_bodies
+        self.lock = threading.RLock()
+        self.sync_lock = threading.Lock()
+        self.index = {}  # sid -> {"updated": ts, "count": rows already in the store}
+        self.titles = {}
+        self.bodies = OrderedDict()
+        self.unsynced = {}  # sid -> rows appended here that no sync has seen yet; those bodies are never evicted
+        self.counter = 0
+        self.cursor = None
+
+    def _flush(self):
+        """Our own pending rows must land first, or a reload would miss them. False while the writer is backing off."""
+        return self.writer.flush() if self.writer else True
+
+    def _pending(self, sid, rows):
+        # The writer is backing off: rows of ours still queued for sid, minus any written since `rows` was read
+        queued = self.writer.pending(sid) if self.writer else []
+        tail = [list(r[:4]) for r in rows[-len(queued):]] if queued else []
+        return [r for r in queued if list(r) not in tail]
+
+    # --- READS ---
+    def session_ids(self):
+        with self.lock: return list(self.index)
+
+    def meta(self, sid):
+        with self.lock: return dict(self.index.get(sid, {"updated": "", "count": 0}))
+
+    def messages(self, sid):
+        with self.lock:
+            if sid in self.bodies:
+                self.bodies.move_to_end(sid)
+                return self.bodies[sid]
+            known = sid in self.index
+        msgs = []
+        if self.store and known:
+            flushed = self._flush()
+            rows = self.store.load_session(sid)
+            if not flushed: rows = rows + self._pending(sid, rows)
+            msgs = [{"role": row[2], "content": row[3]} for row in rows]
+        with self.lock:
+            msgs = self.bodies.setdefault(sid, msgs)
+            self._evict()
+            return msgs
+
+    def _evict(self):
+        # Without a store the cache is the only copy, so never evict. Nor bodies the store can't give back yet
+        while self.store and len(self.bodies) > self.max_bodies:
+            victim = next((sid for sid in self.bodies if not self.unsynced.get(sid)), None)
+            if victim is None: return
+            del self.bodies[victim]
+
+    # --- SYNC ---
+    def sync(self):
+        """Merges rows added since the last sync. Falls back to re-reading the index only when a wipe/delete is detected."""
+        if not self.store: return
+        with self.sync_lock, get_metrics().span("history_sync") as span:
+            self._flush()
+            delta = self.store.read_since(self.cursor) if self.cursor else None
+            span["mode"] = "delta" if delta else "full"
+            if delta:
+                rows, self.cursor = delta
+                self._merge_rows(rows)
+            else:
+                sessions, self.cursor = self.store.read_index()
+                with self.lock:
+                    # A loaded body is still good only if the store holds what we hold, less rows of ours not written yet
+                    self.bodies = OrderedDict((sid, msgs) for sid, msgs in self.bodies.items()
+                                              if 0 <= len(msgs) - sessions.get(sid, {}).get("count", 0) <= self.unsynced.get(sid, 0))
+                    self.unsynced = {sid: len(msgs) - sessions.get(sid, {}).get("count", 0) for sid, msgs in self.bodies.items()}
+                    self.index = sessions
+                    self.titles = {sid: t for sid, t in self.titles.items() if sid in sessions}
+                    untitled = [sid for sid in sessions if sid not in self.titles]
+                self._title_sessions(untitled)
+            with self.lock:
+                self.counter = max([self.counter] + [_session_num(sid) for sid in self.index])
+
+    def _merge_rows(self, rows):
+        temp_first_msgs = {}
+        with self.lock:
+            for ts, sid, role, txt in (row[:4] for row in rows):
+                meta = self.index.setdefault(sid, {"updated": "", "count": 0})
+                # Rows we wrote ourselves are already in memory: per-session order is preserved, so compare positions
+                body = self.bodies.get(sid)
+                if body is not None and meta["count"] >= len(body): body.append({"role": role, "content": txt})
+                elif self.unsynced.get(sid): self.unsynced[sid] -= 1
+                meta["count"] += 1
+                meta["updated"] = max(meta["updated"], ts)
+                if role == "user" and sid not in self.titles and sid not in temp_first_msgs: temp_first_msgs[sid] = txt
+        if temp_first_msgs:
+            titles = resolve_titles(temp_first_msgs)
+            with self.lock: self.titles.update(titles)
+
+    def _first_user_msg(self, sid):
+        return next((row[3] for row in self.store.load_session(sid) if row[2] == "user"), None)
+
+    def _title_sessions(self, sids):
+        if not sids: return
+        try: stored = self.store.load_titles()
+        except: stored = {}
+        # First messages in one read per worksheet; only sessions that don't open with a user row cost a full load
+        try: first_msgs = self.store.first_user_messages(sids)
+        except: first_msgs = {}
+        missing = [sid for sid in sids if sid not in first_msgs]
+        if missing:
+            with ThreadPoolExecutor(max_workers=TITLE_WORKERS) as pool:
+                first_msgs.update(zip(missing, pool.map(self._first_user_msg, missing)))
+        titles = resolve_titles({sid: msg for sid, msg in first_msgs.items() if msg}, stored)
+        with self.lock: self.titles.update(titles)
+
+    # --- MUTATIONS (keep the cache in step with the store) ---
+    def new_session_id(self):
+        with self.lock:
+            self.counter += 1
+            return f"Session {self.counter}"
+
+    def append(self, sid, role, content):
+        msgs = self.messages(sid)
+        with self.lock:
+            msgs = self.bodies.setdefault(sid, msgs)  # evicted again since the load: put it back
+            msgs.append({"role": role, "content": content})
+            self.unsynced[sid] = self.unsynced.get(sid, 0) + 1
+            self.index.setdefault(sid, {"updated": "", "count": 0})["updated"] = _now()
+            self._evict()
+
+    def set_title(self, sid, title):
+        with self.lock: self.titles[sid] = title
+
+    def forget(self, sid):
+        with self.lock:
+            self.index.pop(sid, None)
+            self.bodies.pop(sid, None)
+            self.unsynced.pop(sid, None)
+            self.titles.pop(sid, None)
+
+    def reset(self):
+        with self.lock:
+            self.index, self.titles, self.bodies, self.unsynced = {}, {}, OrderedDict(), {}
+            self.counter, self.cursor = 0, None
+
+@st.cache_resource
+def get_history_cache():
+    cache = HistoryCache(store, get_log_writer())
+    try: cache.sync()
+    except: pass
+    return cache
+
+# --- PER-USER VIEW ---
+def session_ids():
+    ids = history.session_ids()
+    return ids + [sid for sid in st.session_state.draft_sessions if sid not in ids]
+
+def session_title(sid):
+    return history.titles.get(sid, "New Chat")
+
+def get_session_messages(sid):
+    try: return history.messages(sid)
+    except Exception as e:
+        st.error(f"DB Error: {e}")
+        return []
+
+def add_message(sid, role, content):
+    history.append(sid, role, content)
+    if sid in st.session_state.draft_sessions: st.session_state.draft_sessions.remove(sid)
+    save_to_sheet_background(sid, role, content)
+
+def new_session():
+    new_name = history.new_session_id()
+    st.session_state.draft_sessions.append(new_name)
+    st.session_state.active_session_id = new_name
+
+def ensure_active_session():
+    if not session_ids(): new_session()
+    if st.session_state.active_session_id not in session_ids():
+        st.session_state.active_session_id = session_ids()[-1]
 
-# --- 7. HISTORY LOADER ---
 if "history_loaded" not in st.session_state:
-    st.session_state.chat_sessions = {"Session 1": []}
-    st.session_state.session_titles = {"Session 1": "New Chat"}
-    st.session_state.active_session_id = "Session 1"
-    st.session_state.session_counter = 1
-    
-    if sheet:
-        try:
-            with st.spinner("🔄 Syncing History..."):
-                data = sheet.get_all_values()
-                if len(data) > 1:
-                    rebuilt = {}
-                    titles = {}
-                    max_num = 1
-                    temp_first_msgs = {} 
-                    for row in data[1:]: 
-                        if len(row) >= 4:
-                            sid, role, txt = row[1], row[2], row[3]
-                            if sid not in rebuilt: rebuilt[sid] = []
-                            rebuilt[sid].append({"role": role, "content": txt})
-                            if role == "user" and sid not in temp_first_msgs: temp_first_msgs[sid] = txt
-                            try:
-                                n = int(sid.replace("Session ", ""))
-                                if n > max_num: max_num = n
-                            except: pass
-                    
-                    for sid, first_msg in temp_first_msgs.items():
-                        titles[sid] = get_smart_title(first_msg)
-
-                    if rebuilt:
-                        st.session_state.chat_sessions = rebuilt
-                        st.session_state.session_titles = titles
-                        st.session_state.session_counter = max_num
-                        st.session_state.active_session_id = list(rebuilt.keys())[-1]
-            st.session_state.history_loaded = True
-        except: st.session_state.history_loaded = True
-    else: st.session_state.history_loaded = True
+    st.session_state.draft_sessions = []
+    st.session_state.active_session_id = None
+    with st.spinner("🔄 Syncing History..."):
+        history = get_history_cache()
+        try: history.sync()  # cheap delta: pick up what other processes wrote since the cache was built
+        except: pass
+    ensure_active_session()
+    st.session_state.history_loaded = True
+history = get_history_cache()
 
 # --- 8. HELPER FUNCTIONS ---
 def format_chat_log(session_name, messages):
-    log_text = f"--- LOG: {session_name} ---\nDate: {datetime.now()}\n\n"
-    if not messages: return log_text + "(Empty)"
-    for msg in messages:
-        role = "AI" if msg["role"] == "assistant" else "USER"
-        log_text += f"[{role}]:\n{msg['content']}\n\n{'-'*40}\n\n"
-    return log_text
-
-# --- ⚡ BACKGROUND SAVE ---
-def _save_task(session_id, role, content):
-    if sheet:
-        try:
-            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            sheet.append_row([timestamp, session_id, role, content])
-        except: pass
-
-def save_to_sheet_background(session_id, role, content):
-    thread = threading.Thread(target=_save_task, args=(session_id, role, content))
-    thread.start()
+    header = f"--- LOG: {session_name} ---\nDate: {datetime.now()}\n\n"
+    if not messages: return header + "(Empty)"
+    return header + "".join(f"[{'AI' if msg['role'] == 'assistant' else 'USER'}]:\n{msg['content']}\n\n{'-'*40}\n\n" for msg in messages)
 
 def clear_google_sheet():
-    if sheet:
-        try:
-            sheet.clear()
-            sheet.append_row(["Timestamp", "Session ID", "Role", "Content"])
+    if store:
+        writer = get_log_writer()
+        if writer: writer.flush()
+        try: store.wipe()
         except Exception as e: st.error(f"DB Error: {e}")
+    history.reset()
 
 def delete_session_from_db(session_id):
-    if sheet:
+    if store:
+        writer = get_log_writer()
+        if writer: writer.flush()
         try:
-            all_rows = sheet.get_all_values()
-            if not all_rows: return
-            header = all_rows[0]
-            new_rows = [row for row in all_rows[1:] if len(row) > 1 and row[1] != session_id]
-            sheet.clear()
-            sheet.append_row(header)
-            if new_rows: sheet.update(range_name='A2', values=new_rows)
+            with get_metrics().span("delete_session"): store.delete_session(session_id)
         except Exception as e: st.error(f"DB Error: {e}")
+    history.forget(session_id)
+
+# --- ⚡ RESPONSE CACHE ---
+# Opt-in (RESPONSE_CACHE = true in secrets). Many chats open with the same discovery prompt, and the answer
+# only depends on the system prompt, the KB, the conversation so far and the attachments. An identical
+# request replays the stored answer through st.write_stream instead of running a full generation.
+RESPONSE_CACHE_SIZE = int(st.secrets.get("RESPONSE_CACHE_SIZE", 256))
+RESPONSE_CACHE_TTL = int(st.secrets.get("RESPONSE_CACHE_TTL", 24 * 3600))
+RESPONSE_CACHE_MAX_BYTES = 32 * 1024 * 1024
+REPLAY_CHUNK_CHARS = 160
+
+def _normalize(text):
+    return " ".join(text.split()).casefold()
+
+class ResponseCache:
+    """In-process LRU of {key: (stored_at, text, generation_ms)}, bounded by entry count, total size and age."""
+    def __init__(self, max_entries=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL, max_bytes=RESPONSE_CACHE_MAX_BYTES):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+        self.stats = {"lookups": 0, "hits": 0, "stores": 0, "evictions": 0, "saved_ms": 0.0}
+
+    @staticmethod
+    def key(model_name, system_prompt, kb_version, msgs, attachments):
+        """msgs must end with the new user prompt; attachments are the content digests of the files sent with it."""
+        digest = hashlib.sha256()
+        for part in (model_name, system_prompt, kb_version):
+            digest.update(part.encode("utf-8")); digest.update(b"\x1f")
+        for m in msgs:
+            digest.update(f"{m['role']}:{_normalize(m['content'])}".encode("utf-8")); digest.update(b"\x1e")
+        for attachment in attachments or []:
+            digest.update(attachment.encode("ascii"))
+        return digest.hexdigest()
+
+    def _drop(self, key):
+        _, text, _ = self.entries.pop(key)
+        self.size -= len(text)
+
+    def get(self, key):
+        with self.lock:
+            self.stats["lookups"] += 1
+            entry = self.entries.get(key)
+            if entry is None: return None
+            if time.time() - entry[0] > self.ttl:
+                self._drop(key)
+                return None
+            self.entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return entry
+
+    def put(self, key, text, generation_ms):
+        if not text or len(text) > self.max_bytes: return
+        with self.lock:
+            if key in self.entries: self._drop(key)
+            self.entries[key] = (time.time(), text, generation_ms)
+            self.size += len(text)
+            self.stats["stores"] += 1
+            while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                self._drop(next(iter(self.entries)))
+                self.stats["evictions"] += 1
+
+    def replay(self, entry):
+        """Yields the stored answer in render-sized pieces and books the time saved against the original generation."""
+        started = time.perf_counter()
+        _, text, generation_ms = entry
+        for i in range(0, len(text), REPLAY_CHUNK_CHARS): yield text[i:i + REPLAY_CHUNK_CHARS]
+        saved = generation_ms - (time.perf_counter() - started) * 1000
+        with self.lock: self.stats["saved_ms"] += max(saved, 0.0)
+
+    def hit_rate(self):
+        return self.stats["hits"] / self.stats["lookups"] if self.stats["lookups"] else 0.0
+
+@st.cache_resource
+def get_response_cache():
+    if not st.secrets.get("RESPONSE_CACHE", False): return None
+    cache = ResponseCache()
+    get_metrics().register("response_cache", lambda: {**cache.stats, "entries": len(cache.entries), "bytes": cache.size})
+    return cache
+
+# --- ⚡ EXPORT FILES ---
+# Bulk exports (chat_export.py) are built into temp files. One process-wide set tracks the ones not downloaded
+# yet, and a single exit handler removes whatever is left.
+@st.cache_resource
+def get_export_files():
+    files = set()
+    atexit.register(lambda: [os.remove(p) for p in list(files) if os.path.exists(p)])
+    return files
+
+def drop_export():
+    path = st.session_state.pop("export_path", None)
+    if not path: return
+    get_export_files().discard(path)
+    if os.path.exists(path): os.remove(path)
 
 # --- 9. SIDEBAR ---
 with st.sidebar:
@@ -233,35 +885,35 @@ with st.sidebar:
     if "confirm_del_chat" not in st.session_state: st.session_state.confirm_del_chat = False
 
     if st.button("➕ New Chat", use_container_width=True, type="primary"):
-        st.session_state.session_counter += 1
-        new_name = f"Session {st.session_state.session_counter}"
-        st.session_state.chat_sessions[new_name] = []
-        st.session_state.session_titles[new_name] = "New Chat"
-        st.session_state.active_session_id = new_name
+        new_session()
         st.rerun()
 
     st.divider()
 
-    names = list(st.session_state.chat_sessions.keys())
+    names = session_ids()
     if not names: st.caption("No history found.")
     else:
         for name in names[::-1]:
-            display = st.session_state.session_titles.get(name, name)
+            display = session_title(name)
+            meta = history.meta(name)
             btn_type = "primary" if name == st.session_state.active_session_id else "secondary"
             prefix = "🟢 " if name == st.session_state.active_session_id else ""
-            if st.button(f"{prefix}{display}", key=f"btn_{name}", use_container_width=True, type=btn_type):
+            if st.button(f"{prefix}{display}", key=f"btn_{name}", use_container_width=True, type=btn_type,
+                         help=f"{meta['count']} messages · updated {meta['updated'] or 'just now'}"):
                 st.session_state.active_session_id = name
                 st.rerun()
 
     st.divider()
     
     if st.session_state.active_session_id:
-        curr = st.session_state.chat_sessions[st.session_state.active_session_id]
+        curr = get_session_messages(st.session_state.active_session_id)
         st.download_button("📥 Download Log", format_chat_log(st.session_state.active_session_id, curr), f"Log_{st.session_state.active_session_id}.txt", use_container_width=True)
 
     if st.button("🔄 Refresh Memory", use_container_width=True):
-        st.cache_resource.clear()
-        st.session_state.pop("history_loaded", None)
+        if store:
+            try: history.sync()
+            except Exception as e: st.error(f"DB Error: {e}")
+        ensure_active_session()
         st.rerun()
 
     disable_del = st.session_state.active_session_id is None
@@ -270,17 +922,9 @@ with st.sidebar:
          c1, c2 = st.columns(2)
          if c1.button("✅ Yes"):
              sid = st.session_state.active_session_id
-             delete_session_from_db(sid)
-             del st.session_state.chat_sessions[sid]
-             if sid in st.session_state.session_titles: del st.session_state.session_titles[sid]
-             remaining = list(st.session_state.chat_sessions.keys())
-             if remaining: st.session_state.active_session_id = remaining[-1]
-             else:
-                 st.session_state.session_counter += 1
-                 new_name = f"Session {st.session_state.session_counter}"
-                 st.session_state.chat_sessions[new_name] = []
-                 st.session_state.session_titles[new_name] = "New Chat"
-                 st.session_state.active_session_id = new_name
+             if sid in st.session_state.draft_sessions: st.session_state.draft_sessions.remove(sid)
+             else: delete_session_from_db(sid)
+             ensure_active_session()
              st.session_state.confirm_del_chat = False
              st.rerun()
          if c2.button("❌ Cancel"):
@@ -296,10 +940,8 @@ with st.sidebar:
         c1, c2 = st.columns(2)
         if c1.button("✅ Yes"): 
             clear_google_sheet()
-            st.session_state.chat_sessions = {"Session 1": []}
-            st.session_state.session_titles = {"Session 1": "New Chat"}
-            st.session_state.active_session_id = "Session 1"
-            st.session_state.session_counter = 1
+            st.session_state.draft_sessions = []
+            ensure_active_session()
             st.session_state.confirm_wipe = False
             st.rerun()
         if c2.button("❌ No"):
@@ -314,6 +956,78 @@ with st.sidebar:
         st.session_state.password_correct = False
         st.rerun()
 
+    # --- ADMIN DIAGNOSTICS (ADMIN_PASSWORD login only) ---
+    if st.session_state.get("is_admin"):
+        with st.expander("📊 Diagnostics"):
+            writer = get_log_writer()
+            if writer:
+                st.caption(f"💾 Sync queue: {writer.depth()} pending · {writer.stats['dropped']} dropped")
+            rerun_times = sorted(st.session_state.get("rerun_times", []))
+            if rerun_times:
+                p50, p95 = _percentile(rerun_times, 0.5), _percentile(rerun_times, 0.95)
+                flag = "⚠️" if p50 > RERUN_BUDGET_MS else "⏱️"
+                st.caption(f"{flag} Rerun: p50 {p50:.0f} ms · p95 {p95:.0f} ms · budget {RERUN_BUDGET_MS} ms")
+            response_cache = get_response_cache()
+            if response_cache and response_cache.stats["lookups"]:
+                st.caption(f"⚡ Response cache: {response_cache.hit_rate():.0%} hits · {response_cache.stats['saved_ms'] / 1000:.0f}s saved")
+            api = get_api_guard().totals()
+            if any(api.values()):
+                st.caption(f"🚦 API: {api['retries']} retries · {api['throttled']} throttled · {api['failures']} failed")
+            metrics = get_metrics()
+            stages = metrics.summary()
+            if stages:
+                st.dataframe([{"stage": stage, "n": v["count"], "p50 ms": round(v["p50"], 1), "p95 ms": round(v["p95"], 1)} for stage, v in stages.items()],
+                             hide_index=True, use_container_width=True)
+            else: st.caption("No spans recorded yet.")
+            if st.session_state.get("last_stream_stats"): st.json(st.session_state.last_stream_stats, expanded=False)
+            st.json(get_api_guard().snapshot(), expanded=False)
+            if writer: st.json(writer.stats, expanded=False)
+            if st.button("🧹 Compact archives", use_container_width=True):
+                if store:
+                    if writer: writer.flush()
+                    try:
+                        with metrics.span("compact"): reclaimed = store.compact()
+                        st.toast(f"Compacted: {reclaimed} rows reclaimed")
+                    except Exception as e: st.error(f"DB Error: {e}")
+            st.download_button("⬇️ Prometheus snapshot", metrics.prometheus(), file_name="metrics.prom", mime="text/plain", use_container_width=True)
+
+        # --- BULK EXPORT / IMPORT (chat_export.py) ---
+        with st.expander("📦 Export / Import"):
+            if not store: st.caption("No database connection.")
+            else:
+                import chat_export
+                fmt = st.radio("Format", list(chat_export.FORMATS), horizontal=True, format_func=lambda f: {"jsonl": "JSONL", "csv": "CSV", "md": "Markdown"}[f])
+                picked = st.multiselect("Sessions (none = all)", names, format_func=session_title)
+                if st.button("Build export", use_container_width=True):
+                    if writer: writer.flush()
+                    try:
+                        with get_metrics().span("export", format=fmt) as span:
+                            path, manifest = chat_export.export_zip(store, fmt, picked or None)
+                            span["rows"] = manifest["rows"]
+                        drop_export()
+                        get_export_files().add(path)
+                        st.session_state.export_path = path
+                    except Exception as e: st.error(f"Export failed: {e}")
+                path = st.session_state.get("export_path")
+                if path and os.path.exists(path):
+                    # The zip is built on disk and handed over only until it has been downloaded once
+                    with open(path, "rb") as f:
+                        served = st.download_button("⬇️ Download export", f, file_name=f"chat_export_{datetime.now():%Y%m%d_%H%M}.zip", mime="application/zip", use_container_width=True)
+                    if served: drop_export()
+                upload = st.file_uploader("Import an export (JSONL or CSV)", type="zip")
+                if upload and st.button("Import", use_container_width=True):
+                    if writer: writer.flush()
+                    try:
+                        with get_metrics().span("import") as span:
+                            # IDs up to the counter may belong to draft sessions that have no rows yet
+                            result = chat_export.import_zip(store, upload, new_session_id=history.new_session_id, reserved=history.counter)
+                            span["rows"] = result["rows"]
+                        history.sync()  # imported rows are plain appends: the delta sync picks them up
+                        ensure_active_session()
+                        renamed = f" · {len(result['renamed'])} sessions got new IDs" if result["renamed"] else ""
+                        st.toast(f"Imported {result['rows']} rows in {result['sessions']} sessions ({result['skipped']} rows already present{renamed})")
+                    except Exception as e: st.error(f"Import failed: {e}")
+
 # --- 10. MAIN INTERFACE ---
 col_logo, col_title = st.columns([0.15, 0.85]) 
 with col_logo:
@@ -322,41 +1036,139 @@ with col_logo:
 st.markdown("<h3>Beverage Innovator 3.0</h3>", unsafe_allow_html=True)
 
 # --- 11. KNOWLEDGE BASE (TURBO CACHED) ---
-@st.cache_resource
-def load_knowledge_base():
-    if "kb_files" in st.session_state:
-        return st.session_state.kb_files
-
-    files = ["bible1.pdf", "bible2.pdf", "studies.pdf", "clients.csv"]
-    loaded = []
-    
-    try: existing_files = {f.display_name: f for f in genai.list_files()}
-    except: existing_files = {}
+# A local manifest maps each KB file's content hash to its uploaded copy and expiry time.
+# Unchanged files are reused; edited or nearly expired ones are re-uploaded, all in parallel.
+KB_FILES = ["bible1.pdf", "bible2.pdf", "studies.pdf", "clients.csv"]
+KB_MANIFEST = ".kb_manifest.json"
+KB_FILE_TTL = 48 * 3600          # Gemini keeps uploaded files for 48h
+KB_REFRESH_MARGIN = 6 * 3600     # re-upload this long before they expire
+KB_UPLOAD_TIMEOUT = 300
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""): digest.update(block)
+    return digest.hexdigest()
+
+def _load_manifest():
+    try:
+        with open(KB_MANIFEST) as f: return json.load(f)
+    except (OSError, ValueError): return {}
+
+def _save_manifest(manifest):
+    tmp = KB_MANIFEST + ".tmp"
+    with open(tmp, "w") as f: json.dump(manifest, f, indent=2)
+    os.replace(tmp, KB_MANIFEST)
+
+def _wait_until_active(ref, guard, timeout=KB_UPLOAD_TIMEOUT):
+    delay, deadline = 0.5, time.monotonic() + timeout
+    while ref.state.name == "PROCESSING":
+        if time.monotonic() > deadline: raise TimeoutError(f"{ref.display_name} still processing after {timeout}s")
+        time.sleep(delay)
+        delay = min(delay * 2, 8)
+        ref = guard.call("gemini", genai.get_file, ref.name)
+    if ref.state.name != "ACTIVE": raise RuntimeError(f"{ref.display_name} is {ref.state.name}")
+    return ref
+
+def _manifest_entry(ref, digest):
+    expiry = getattr(ref, "expiration_time", None)
+    expires_at = expiry.timestamp() if expiry else time.time() + KB_FILE_TTL
+    return {"sha256": digest, "name": ref.name, "expires_at": expires_at}
+
+def _sync_kb_file(filename, digest, entry, guard):
+    """Returns (file_ref, manifest_entry), uploading only if the file changed or is about to expire."""
+    if entry and entry["sha256"] == digest and entry["expires_at"] - time.time() > KB_REFRESH_MARGIN:
+        try:
+            ref = guard.call("gemini", genai.get_file, entry["name"])
+            if ref.state.name == "ACTIVE": return ref, entry
+        except Exception: pass
+    ref = _wait_until_active(guard.call("gemini", genai.upload_file, filename, display_name=filename), guard)
+    if entry and entry["name"] != ref.name:
+        try: genai.delete_file(entry["name"])
+        except Exception: pass
+    return ref, _manifest_entry(ref, digest)
+
+def _adopt_remote_files(manifest, digests):
+    # No manifest entry yet (fresh container): reuse a remote copy with the same display name and bytes
+    try: remote = {f.display_name: f for f in genai.list_files()}
+    except Exception: return
+    for filename, digest in digests.items():
+        ref = remote.get(filename)
+        if filename in manifest or ref is None: continue
+        if getattr(ref, "sha256_hash", None) in (bytes.fromhex(digest), digest.encode()):
+            manifest[filename] = _manifest_entry(ref, digest)
+
+def _kb_stat(files=KB_FILES):
+    """Cheap per-rerun fingerprint of the KB files, so edits on disk invalidate the cached KB."""
+    return tuple((f, os.path.getmtime(f), os.path.getsize(f)) for f in files if os.path.exists(f))
+
+@st.cache_resource(ttl=3600)  # hourly re-check keeps files well inside KB_REFRESH_MARGIN
+def load_knowledge_base(kb_stat):
+    files = [f for f, _, _ in kb_stat]
+    digests = {f: _file_sha256(f) for f in files}
+    manifest = _load_manifest()
+    if any(f not in manifest for f in files): _adopt_remote_files(manifest, digests)
+
+    loaded, new_manifest, guard = [], {}, get_api_guard()
+    with get_metrics().span("kb_load", files=len(files)), ThreadPoolExecutor(max_workers=max(len(files), 1)) as pool:
+        futures = {f: pool.submit(_sync_kb_file, f, digests[f], manifest.get(f), guard) for f in files}
+        for filename in files:
+            try: ref, new_manifest[filename] = futures[filename].result()
+            except Exception: continue
+            loaded.append(ref)
+    try: _save_manifest(new_manifest)
+    except OSError: pass
+    # Version of what was actually loaded; keys the server-side context cache
+    kb_version = hashlib.sha256(json.dumps(sorted((f, e["sha256"]) for f, e in new_manifest.items())).encode()).hexdigest()
+    return loaded, kb_version
+
+# --- ⚡ RETRIEVAL MODE (KB_MODE = "retrieval") ---
+# Instead of attaching every KB file, send only the top passages from the offline index
+# built by `python kb_index.py build`. Falls back to attaching the files if there is no index, or if a KB file
+# changed since it was built.
+KB_MODE = st.secrets.get("KB_MODE", "files")
+KB_INDEX_PATH = "kb_index.json"
+KB_TOP_K = 6
 
-    for filename in files:
-        if not os.path.exists(filename): continue
-        if filename in existing_files:
-            try:
-                file_ref = genai.get_file(existing_files[filename].name)
-                loaded.append(file_ref)
-            except Exception:
-                try:
-                    ref = genai.upload_file(filename, display_name=filename)
-                    while ref.state.name == "PROCESSING": time.sleep(1); ref = genai.get_file(ref.name)
-                    loaded.append(ref)
-                except: pass
-        else:
-            try:
-                ref = genai.upload_file(filename, display_name=filename)
-                while ref.state.name == "PROCESSING": time.sleep(1); ref = genai.get_file(ref.name)
-                loaded.append(ref)
-            except: pass
-            
-    st.session_state.kb_files = loaded 
-    return loaded
+@st.cache_resource
+def load_kb_index(index_mtime, kb_stat):
+    """(index, stale source files). kb_stat keys the cache, so the sources are only re-hashed when they change."""
+    from kb_index import KBIndex, DEFAULT_SOURCES
+    try: index = KBIndex.load(KB_INDEX_PATH)
+    except (OSError, ValueError): return None, []
+    stale = index.stale_sources(DEFAULT_SOURCES)
+    return (None if stale else index), stale
+
+def retrieve_passages(index, prompt, history_msgs):
+    """(passages_text, hits, elapsed_ms) for the prompt plus the last couple of turns."""
+    from kb_index import format_passages
+    query = " ".join([m["content"] for m in history_msgs[-3:-1]] + [prompt])
+    started = time.perf_counter()
+    hits = index.search(query, KB_TOP_K)
+    return format_passages(hits), hits, (time.perf_counter() - started) * 1000
+
+# --- ⚡ CLIENT BRIEFS ---
+# clients.csv is parsed into a (client, variable) table instead of being attached as a blob; each turn gets
+# only the brief of the client the conversation is about. Reloaded whenever the file changes.
+CLIENTS_CSV = "clients.csv"
 
-with st.spinner("⚡ Starting Engine 3.0..."):
-    knowledge_base = load_knowledge_base()
+@st.cache_resource
+def load_client_briefs(csv_mtime):
+    from client_briefs import ClientBriefs
+    try: return ClientBriefs.load(CLIENTS_CSV)
+    except (OSError, ValueError): return None
+
+client_briefs = load_client_briefs(os.path.getmtime(CLIENTS_CSV)) if os.path.exists(CLIENTS_CSV) else None
+
+kb_index, kb_stale = load_kb_index(os.path.getmtime(KB_INDEX_PATH), _kb_stat()) if KB_MODE == "retrieval" and os.path.exists(KB_INDEX_PATH) else (None, [])
+if kb_stale and st.session_state.get("is_admin"):
+    st.sidebar.warning(f"⚠️ {KB_INDEX_PATH} is out of date ({', '.join(kb_stale)}); attaching the files instead. Run `python kb_index.py build`.")
+if kb_index:
+    knowledge_base, kb_version = [], ""
+else:
+    with st.spinner("⚡ Starting Engine 3.0..."):
+        # The CSV is only uploaded if it could not be parsed into briefs
+        knowledge_base, kb_version = load_knowledge_base(_kb_stat([f for f in KB_FILES if not (client_briefs and f == CLIENTS_CSV)]))
 
 # --- 12. SMART PROMPT ---
 HIDDEN_PROMPT = """
@@ -421,26 +1233,226 @@ Would you like me to expand on any ideas, combine any flavors, or provide the re
 """
 
 # --- 13. MODEL SELECTOR (STRICT GEMINI 3) ---
+CHAT_MODEL = "gemini-3-flash-preview"
 try:
-    model = genai.GenerativeModel("gemini-3-flash-preview", system_instruction=HIDDEN_PROMPT)
-    st.toast("🚀 Running on Gemini 3 Flash Preview!")
+    model = get_model(CHAT_MODEL, HIDDEN_PROMPT)
+    if not st.session_state.get("model_announced"):
+        st.toast("🚀 Running on Gemini 3 Flash Preview!")
+        st.session_state.model_announced = True
 except Exception as e:
     st.error(f"⚠️ Gemini 3 Flash Not Available. Error: {e}")
     st.stop()
 
+# --- ⚡ CONTEXT CACHE (SYSTEM PROMPT + KNOWLEDGE BASE) ---
+# Opt-in (CONTEXT_CACHE = true in secrets). See context_cache.py; its Gemini calls share the API guard.
+@st.cache_resource
+def get_context_cache():
+    return ContextCache(genai, CHAT_MODEL, guard=get_api_guard()) if st.secrets.get("CONTEXT_CACHE", False) else None
+
+# --- ⚡ CONVERSATION WINDOW (TOKEN BUDGET + ROLLING SUMMARY) ---
+# The summary plus the newest turns sent verbatim stay within CONTEXT_TOKEN_BUDGET; older turns are folded
+# into the summary, which is capped at a quarter of the budget. When the window overflows it is pulled back to
+# half the budget, so the summary is rebuilt once every few turns instead of on every turn.
+CONTEXT_TOKEN_BUDGET = int(st.secrets.get("CONTEXT_TOKEN_BUDGET", 16000))
+SUMMARY_TOKEN_CAP = CONTEXT_TOKEN_BUDGET // 4
+SUMMARY_MODEL = "gemini-1.5-flash"
+FALLBACK_LINE = "- User asked: "
+
+def estimate_tokens(text):
+    return len(text) // 4 + 1  # ~4 chars per token; a local estimate keeps counting free
+
+def _cap_summary(text, cap=SUMMARY_TOKEN_CAP):
+    """Fits a summary into the cap: drops the oldest "User asked" lines of a fallback summary first, then cuts the end."""
+    lines = text.splitlines()
+    while estimate_tokens("\n".join(lines)) > cap:
+        oldest = next((i for i, line in enumerate(lines) if line.startswith(FALLBACK_LINE)), None)
+        if oldest is None: break
+        del lines[oldest]
+    return "\n".join(lines)[:cap * 4]
+
+def summarize_turns(previous_summary, msgs):
+    transcript = "\n\n".join(f"{'AI' if m['role'] == 'assistant' else 'USER'}: {m['content']}" for m in msgs)
+    try:
+        with get_metrics().span("summarize", turns=len(msgs)):
+            response = get_api_guard().call("gemini", get_model(SUMMARY_MODEL).generate_content,
+                "Update the running summary of a drink-innovation brainstorming chat. Keep client details, objectives, "
+                f"idea numbers and names, chosen ideas and recipe decisions. Be concise: at most {SUMMARY_TOKEN_CAP * 3 // 4} words.\n\n"
+                f"Current summary:\n{previous_summary or '(none)'}\n\nNew turns:\n{transcript}")
+        return _cap_summary(response.text.strip())
+    except Exception:
+        # Keep the gist without the model: the user's requests are what later turns refer back to
+        asks = [m["content"][:200] for m in msgs if m["role"] == "user"]
+        return _cap_summary("\n".join(filter(None, [previous_summary] + [f"{FALLBACK_LINE}{a}" for a in asks])))
+
+class ContextWindow:
+    def __init__(self, budget, summarize=summarize_turns):
+        self.budget = budget
+        self.summarize = summarize
+        self.reset()
+
+    def reset(self):
+        self.token_counts = []  # per message, appended as the session grows
+        self.fold_at = 0        # msgs[:fold_at] are covered by self.summary
+        self.summary = ""
+        self.boundary = None    # content hash of msgs[fold_at - 1], to notice the session changing underneath
+
+    def _hash(self, msg):
+        return hashlib.sha1(msg["content"].encode("utf-8")).hexdigest()
+
+    def build(self, msgs):
+        """Returns (summary, recent_msgs)."""
+        if len(self.token_counts) > len(msgs) or (self.fold_at and self._hash(msgs[self.fold_at - 1]) != self.boundary): self.reset()
+        self.token_counts.extend(estimate_tokens(m["content"]) for m in msgs[len(self.token_counts):])
+        summary_tokens = estimate_tokens(self.summary) if self.summary else 0
+        if summary_tokens + sum(self.token_counts[self.fold_at:]) > self.budget:
+            target, total, start = self.budget // 2, 0, len(msgs)
+            while start > self.fold_at + 1 and total + self.token_counts[start - 1] <= target:
+                start -= 1
+                total += self.token_counts[start]
+            start = min(start, len(msgs) - 1)  # the newest message is always sent verbatim
+            while start < len(msgs) - 1 and msgs[start]["role"] != "user": start += 1  # start on a user turn
+            if start > self.fold_at:
+                self.summary = self.summarize(self.summary, msgs[self.fold_at:start])
+                self.fold_at, self.boundary = start, self._hash(msgs[start - 1])
+        return self.summary, msgs[self.fold_at:]
+
+def get_context_window(sid):
+    windows = st.session_state.setdefault("context_windows", {})
+    if sid not in windows: windows[sid] = ContextWindow(CONTEXT_TOKEN_BUDGET)
+    return windows[sid]
+
 # --- 14. CHAT LOGIC (CUSTOM ICONS) ---
-curr_msgs = st.session_state.chat_sessions[st.session_state.active_session_id]
-for m in curr_msgs:
-    # --- ICON LOGIC ---
-    if m["role"] == "assistant":
-        # Make sure "bot_icon.png" is in your folder!
-        avatar_img = "bot_icon.png" 
-    else:
-        # User = transparent/invisible
-        avatar_img = "transparent.png" 
-        
-    with st.chat_message(m["role"], avatar=avatar_img): 
-        st.markdown(m["content"])
+# History is drawn in its own fragment, as it stood on the last full rerun, so "load earlier" only reruns that
+# block. New turns are sent and drawn by a second fragment (chat_turn, below), so a reply doesn't redraw the
+# history either. Only the newest page of messages is drawn; long older replies are collapsed behind their
+# first line.
+HISTORY_PAGE_SIZE = 12
+COLLAPSE_CHARS = 1500   # older messages longer than this start collapsed
+KEEP_OPEN = 2           # the newest exchange is always shown in full
+
+def _collapse_label(content):
+    """Expander label for a long message (its first non-empty line), or None to show it in full."""
+    if len(content) <= COLLAPSE_CHARS: return None
+    first = next((line.strip(" #*>-") for line in content.splitlines() if line.strip(" #*>-")), "Response")
+    return (first[:70] + " …") if len(first) > 70 else first
+
+def _load_earlier(sid):
+    pages = st.session_state.setdefault("history_pages", {})
+    pages[sid] = pages.get(sid, 1) + 1
+
+def _draw_message(m, label=None):
+    # --- ICON LOGIC --- (make sure "bot_icon.png" is in your folder; user = transparent/invisible)
+    avatar_img = "bot_icon.png" if m["role"] == "assistant" else "transparent.png"
+    with st.chat_message(m["role"], avatar=avatar_img):
+        if label:
+            with st.expander(label): st.markdown(m["content"])
+        else: st.markdown(m["content"])
+
+@st.fragment
+def render_history(sid, end):
+    msgs = get_session_messages(sid)[:end]
+    shown = HISTORY_PAGE_SIZE * st.session_state.get("history_pages", {}).get(sid, 1)
+    hidden = max(len(msgs) - shown, 0)
+    if hidden: st.button(f"⬆️ Load earlier messages ({hidden} more)", key=f"load_earlier_{sid}", on_click=_load_earlier, args=(sid,), use_container_width=True)
+    for i in range(hidden, len(msgs)):
+        _draw_message(msgs[i], _collapse_label(msgs[i]["content"]) if i < len(msgs) - KEEP_OPEN else None)
+
+history_end = len(get_session_messages(st.session_state.active_session_id))
+render_history(st.session_state.active_session_id, history_end)
+
+# --- ⚡ ATTACHMENT PIPELINE ---
+# Uploads are processed once per content hash: text is decoded incrementally up to a cap, large CSVs are
+# summarised from chunked pandas reads (schema, null counts, numeric ranges, a random sample) instead of
+# being sent raw, and images are downscaled and re-encoded to stay under a byte budget.
+ATTACH_TEXT_MAX_CHARS = 400_000
+ATTACH_CSV_INLINE_BYTES = 512 * 1024
+ATTACH_CSV_CHUNK_ROWS = 50_000
+ATTACH_CSV_SAMPLE_ROWS = 25
+ATTACH_IMAGE_MAX_SIDE = 1600
+ATTACH_IMAGE_MAX_BYTES = 1_500_000
+
+def _upload_digest(f):
+    digest = hashlib.sha256()
+    f.seek(0)
+    for block in iter(lambda: f.read(1 << 20), b""): digest.update(block)
+    f.seek(0)
+    return digest.hexdigest()
+
+def _read_text(f, name, limit=ATTACH_TEXT_MAX_CHARS):
+    f.seek(0)
+    reader = io.TextIOWrapper(f, encoding="utf-8", errors="replace", newline="")
+    try:
+        parts, size = [], 0
+        for block in iter(lambda: reader.read(64 * 1024), ""):
+            parts.append(block[:limit - size])
+            size += len(parts[-1])
+            if size >= limit:
+                parts.append(f"\n\n[{name} truncated after {limit:,} characters]")
+                break
+        return "".join(parts)
+    finally:
+        reader.detach()  # leave the upload open for st.image / later reruns
+        f.seek(0)
+
+def _summarize_csv(f, name):
+    import pandas as pd
+    f.seek(0)
+    rows, columns, nulls, mins, maxs, sums, counts, sample = 0, None, None, None, None, None, None, None
+    rng = random.Random(name)
+    for chunk in pd.read_csv(f, chunksize=ATTACH_CSV_CHUNK_ROWS, on_bad_lines="skip", encoding_errors="replace", low_memory=False):
+        rows += len(chunk)
+        if columns is None: columns = chunk.dtypes
+        chunk_nulls = chunk.isna().sum()
+        nulls = chunk_nulls if nulls is None else nulls.add(chunk_nulls, fill_value=0)
+        num = chunk.select_dtypes("number")
+        if not num.empty:
+            lo, hi, total, n = num.min(), num.max(), num.sum(), num.count()
+            mins = lo if mins is None else pd.concat([mins, lo], axis=1).min(axis=1)
+            maxs = hi if maxs is None else pd.concat([maxs, hi], axis=1).max(axis=1)
+            sums = total if sums is None else sums.add(total, fill_value=0)
+            counts = n if counts is None else counts.add(n, fill_value=0)
+        # Uniform sample across chunks: keep the rows with the smallest random keys
+        keyed = chunk.assign(_sample_key=[rng.random() for _ in range(len(chunk))])
+        sample = keyed.nsmallest(ATTACH_CSV_SAMPLE_ROWS, "_sample_key") if sample is None else \
+            pd.concat([sample, keyed]).nsmallest(ATTACH_CSV_SAMPLE_ROWS, "_sample_key")
+    f.seek(0)
+    if columns is None: return f"CSV attachment {name}: empty file."
+    lines = [f"CSV attachment {name}: {rows:,} rows x {len(columns)} columns "
+             f"(summarised because the file is {f.size / 1e6:.1f} MB).", "", "Columns:"]
+    for col, dtype in columns.items():
+        line = f"- {col} ({dtype}): {int(nulls.get(col, 0)):,} empty"
+        if sums is not None and col in sums.index and counts[col]:
+            line += f", min {mins[col]:g}, max {maxs[col]:g}, mean {sums[col] / counts[col]:g}"
+        lines.append(line)
+    lines += ["", f"Random sample of {len(sample)} rows:", sample.drop(columns="_sample_key").to_csv(index=False)]
+    return "\n".join(lines)
+
+def _shrink_image(f):
+    from PIL import Image
+    f.seek(0)
+    img = Image.open(f)
+    img.draft("RGB", (ATTACH_IMAGE_MAX_SIDE, ATTACH_IMAGE_MAX_SIDE))  # JPEG: decode at reduced scale
+    img = img.convert("RGB")
+    img.thumbnail((ATTACH_IMAGE_MAX_SIDE, ATTACH_IMAGE_MAX_SIDE))
+    f.seek(0)
+    for quality in (85, 75, 60, 45):
+        out = io.BytesIO()
+        img.save(out, format="JPEG", quality=quality, optimize=True)
+        if out.tell() <= ATTACH_IMAGE_MAX_BYTES: break
+        if quality == 60: img.thumbnail((img.width * 3 // 4, img.height * 3 // 4))
+    out.seek(0)
+    small = Image.open(out)
+    small.load()
+    return small
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def process_attachment(digest, name, mime_type, _file):
+    """Model-ready part for one upload. Cached by content digest; _file is not hashed."""
+    if "image" in mime_type: return _shrink_image(_file)
+    if name.lower().endswith(".csv") and _file.size > ATTACH_CSV_INLINE_BYTES:
+        try: return _summarize_csv(_file, name)
+        except Exception: pass  # unparseable CSV: fall back to (capped) raw text
+    return _read_text(_file, name)
 
 col1, col2 = st.columns([0.25, 0.75]) 
 with col1:
@@ -451,33 +1463,86 @@ with col1:
         # MULTI-FILE & DYNAMIC KEY
         up_files = st.file_uploader("Drop files here", type=["png", "jpg", "csv", "txt"], label_visibility="collapsed", key=f"uploader_{st.session_state.uploader_key}", accept_multiple_files=True)
         
-        processed_files = []
+        processed_files, attachment_digests = [], []
         if up_files:
             st.success(f"{len(up_files)} Files Ready!")
             for up_file in up_files:
-                if "image" in up_file.type:
-                    st.image(up_file, width=150)
-                    img = Image.open(up_file)
-                    processed_files.append(img)
-                else:
-                    text = up_file.getvalue().decode("utf-8")
-                    processed_files.append(text)
-
-# --- GENERATOR HELPER: QUEUE CONSUMER ---
-def queue_to_stream(q):
-    while True:
+                if "image" in up_file.type: st.image(up_file, width=150)
+                attachment_digests.append(_upload_digest(up_file))
+                processed_files.append(process_attachment(attachment_digests[-1], up_file.name, up_file.type, up_file))
+
+# --- GENERATOR HELPER: EVENT-DRIVEN STREAM ---
+STREAM_MIN_CHARS = 24     # coalesce tiny chunks into render-sized updates...
+STREAM_MAX_WAIT = 0.08    # ...but never hold text back longer than this (seconds)
+
+class ResponseStream:
+    """Runs generate_content(stream=True) on a worker thread; the UI blocks on the queue and wakes on every chunk."""
+    def __init__(self, model, contents, guard):
+        self.q = queue.Queue()
+        self.first = threading.Event()      # set on the first chunk (or on end/error)
+        self.cancelled = threading.Event()  # set when the UI stops reading, e.g. the user navigated away
+        self.stats = {"queue_ms": None, "ttft_ms": None, "total_ms": None, "chunks_in": 0, "updates_out": 0, "chars": 0, "updates_per_s": None}
+        self._started = time.perf_counter()
+        self.thread = threading.Thread(target=self._worker, args=(model, contents, guard), daemon=True)
+        self.thread.start()
+
+    def _put(self, item):
+        self.q.put(item)
+        self.first.set()
+
+    def _worker(self, model, contents, guard):
+        def open_stream():
+            # Rate limits surface when the stream opens; retrying is only safe before any text reaches the UI
+            if self.stats["queue_ms"] is None: self.stats["queue_ms"] = (time.perf_counter() - self._started) * 1000
+            chunks = iter(model.generate_content(contents, stream=True))
+            return chunks, next(chunks, None)
+
         try:
-            chunk = q.get(timeout=0.05)
-            if chunk is None: break  
-            if isinstance(chunk, Exception): raise chunk
-            yield chunk
-        except queue.Empty:
-            continue
-
-if prompt := st.chat_input(f"Innovate here..."):
+            chunks, chunk = guard.call("gemini", open_stream)
+            while chunk is not None:
+                if self.cancelled.is_set(): return
+                if chunk.text: self._put(chunk.text)
+                chunk = next(chunks, None)
+            self._put(None)
+        except Exception as e:
+            self._put(e)
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def __iter__(self):
+        end = False
+        try:
+            while not end:
+                item = self.q.get()
+                if self.stats["ttft_ms"] is None: self.stats["ttft_ms"] = (time.perf_counter() - self._started) * 1000
+                if item is None: break
+                if isinstance(item, Exception): raise item
+                parts, size, deadline = [item], len(item), time.monotonic() + STREAM_MAX_WAIT
+                while size < STREAM_MIN_CHARS:
+                    try: item = self.q.get(timeout=max(deadline - time.monotonic(), 0))
+                    except queue.Empty: break
+                    if item is None: end = True; break
+                    if isinstance(item, Exception): raise item
+                    parts.append(item)
+                    size += len(item)
+                self.stats["chunks_in"] += len(parts)
+                self.stats["updates_out"] += 1
+                self.stats["chars"] += size
+                yield "".join(parts)
+        finally:
+            self.cancel()  # no-op once finished; stops the worker if the script was interrupted
+            elapsed = time.perf_counter() - self._started
+            self.stats["total_ms"] = elapsed * 1000
+            self.stats["updates_per_s"] = self.stats["updates_out"] / elapsed if elapsed else None
+
+def run_turn(prompt):
     
     # User Message
-    st.session_state.chat_sessions[st.session_state.active_session_id].append({"role": "user", "content": prompt})
+    add_message(st.session_state.active_session_id, "user", prompt)
+    # Read the body after adding: it may have been evicted from the shared cache and reloaded since the page
+    # was drawn, and the prompt only lands in the live one
+    curr_msgs = get_session_messages(st.session_state.active_session_id)
     
     # --- RENDER USER MESSAGE (TRANSPARENT ICON) ---
     with st.chat_message("user", avatar="transparent.png"):
@@ -486,87 +1551,128 @@ if prompt := st.chat_input(f"Innovate here..."):
     
     # RESET UPLOADER
     st.session_state.uploader_key += 1
-    
-    save_to_sheet_background(st.session_state.active_session_id, "user", prompt)
 
     # Response with THREADED ANIMATION
     # --- RENDER BOT MESSAGE (DROPLET ICON) ---
     with st.chat_message("assistant", avatar="bot_icon.png"):
         try:
-            # 1. Prepare Data
-            messages_for_api = []
-            if knowledge_base:
-                parts = list(knowledge_base)
-                parts.append("System Context: Reference materials attached. Use them.")
-                messages_for_api.append({"role": "user", "parts": parts})
-                messages_for_api.append({"role": "model", "parts": ["Acknowledged."]})
-
-            for msg in st.session_state.chat_sessions[st.session_state.active_session_id]:
-                role = "model" if msg["role"] == "assistant" else "user"
-                # CHECK IF CURRENT MESSAGE HAS ATTACHMENTS
-                if msg["content"] == prompt and msg == st.session_state.chat_sessions[st.session_state.active_session_id][-1]:
-                      current_parts = [prompt]
-                      if processed_files:
-                          current_parts.extend(processed_files)
-                          if any(isinstance(x, Image.Image) for x in processed_files):
-                              current_parts.append("Analyze these images.")
-                      messages_for_api.append({"role": role, "parts": current_parts})
-                else:
-                      messages_for_api.append({"role": role, "parts": [msg["content"]]})
-
-            # 2. Setup Threading Queue
-            response_queue = queue.Queue()
-            
-            def api_worker():
-                """Runs in background thread to fetch AI response"""
+            # 0. Response cache: same prompt, history, KB and attachments -> replay the stored answer
+            response_cache = get_response_cache()
+            cache_key = response_cache.key(CHAT_MODEL, HIDDEN_PROMPT, f"{KB_MODE}:{kb_version}:{kb_index.built_at if kb_index else ''}:{client_briefs.version if client_briefs else ''}",
+                                           curr_msgs, attachment_digests) if response_cache else None
+            cached_entry = response_cache.get(cache_key) if cache_key else None
+            metrics = get_metrics()
+            if cached_entry:
+                with metrics.span("response_cache_replay"): full_response = st.write_stream(response_cache.replay(cached_entry))
+                if st.session_state.get("is_admin"): st.caption("⚡ Answered from the response cache")
+            else:
+                # 1. Prepare Data
+                build_started = time.perf_counter()
+                messages_for_api = []
+                chat_model = model
+                context_cache = get_context_cache()
+                cached_model = context_cache.model_for(HIDDEN_PROMPT, knowledge_base, kb_version) if context_cache else None
+                retrieved = retrieve_passages(kb_index, prompt, curr_msgs) if kb_index else None
+                if cached_model: chat_model = cached_model  # KB + system prompt already live in the cached context
+                elif retrieved:
+                    passages, hits, retrieval_ms = retrieved
+                    if passages:
+                        messages_for_api.append({"role": "user", "parts": [f"Reference passages from the knowledge base (use them):\n\n{passages}"]})
+                        messages_for_api.append({"role": "model", "parts": ["Acknowledged."]})
+                elif knowledge_base:
+                    parts = list(knowledge_base)
+                    parts.append(KB_CONTEXT_NOTE)
+                    messages_for_api.append({"role": "user", "parts": parts})
+                    messages_for_api.append({"role": "model", "parts": ["Acknowledged."]})
+
+                brief_client, brief, brief_named = client_briefs.brief_for(prompt, curr_msgs) if client_briefs else (None, None, False)
+                if brief:
+                    # Only a named client is "the client in this conversation"; a keyword match is a comparable one
+                    framing = "Brief for the client in this conversation (from our client records)" if brief_named else \
+                              "Brief for a similar past client (from our client records; not the client in this conversation, use it for comparison only)"
+                    messages_for_api.append({"role": "user", "parts": [f"{framing}:\n{brief}"]})
+                    messages_for_api.append({"role": "model", "parts": ["Noted."]})
+
+                summary, recent_msgs = get_context_window(st.session_state.active_session_id).build(curr_msgs)
+                if summary:
+                    messages_for_api.append({"role": "user", "parts": [f"Summary of our earlier conversation:\n{summary}"]})
+                    messages_for_api.append({"role": "model", "parts": ["Understood."]})
+
+                for msg in recent_msgs:
+                    role = "model" if msg["role"] == "assistant" else "user"
+                    # CHECK IF CURRENT MESSAGE HAS ATTACHMENTS
+                    if msg["content"] == prompt and msg is curr_msgs[-1]:
+                          current_parts = [prompt]
+                          if processed_files:
+                              current_parts.extend(processed_files)
+                              if any(not isinstance(x, str) for x in processed_files):  # images
+                                  current_parts.append("Analyze these images.")
+                          messages_for_api.append({"role": role, "parts": current_parts})
+                    else:
+                          messages_for_api.append({"role": role, "parts": [msg["content"]]})
+
+                metrics.record("build_messages", (time.perf_counter() - build_started) * 1000, messages=len(messages_for_api))
+                if retrieved: metrics.record("retrieval", retrieved[2], hits=len(retrieved[1]))
+
+                # 2. Start API Thread
+                response_stream = ResponseStream(chat_model, messages_for_api, get_api_guard())
+
+                # 3. SHOW LOOPING ANIMATION (Until the first chunk arrives)
+                status_placeholder = st.empty()
+                loading_texts = [
+                    "🔍 Analyzing request...",
+                    "📖 Consulting Flavor Bible...",
+                    "🧪 Checking compatibility...",
+                    "🎨 Drafting concepts...",
+                    "✨ Refining details..."
+                ]
+                idx = 0
                 try:
-                    stream = model.generate_content(messages_for_api, stream=True)
-                    for chunk in stream:
-                        if chunk.text: response_queue.put(chunk.text)
-                    response_queue.put(None) # Signal Done
-                except Exception as e:
-                    response_queue.put(e)
-
-            # 3. Start API Thread
-            worker_thread = threading.Thread(target=api_worker)
-            worker_thread.start()
-
-            # 4. SHOW LOOPING ANIMATION (While Queue is Empty)
-            status_placeholder = st.empty()
-            loading_texts = [
-                "🔍 Analyzing request...",
-                "📖 Consulting Flavor Bible...",
-                "🧪 Checking compatibility...",
-                "🎨 Drafting concepts...",
-                "✨ Refining details..."
-            ]
-            idx = 0
-            
-            start_time = time.time()
-            text_update_time = time.time()
+                    while not response_stream.first.wait(0.6 if idx else 0.1):
+                        msg = loading_texts[idx % len(loading_texts)]
+                        status_placeholder.markdown(f"<p class='pulsing-text'>🧠 {msg}</p>", unsafe_allow_html=True)
+                        idx += 1
+                except BaseException:
+                    response_stream.cancel()  # rerun/stop while waiting: don't leave the request running
+                    raise
+
+                # 4. STREAM RESPONSE (Once data arrives)
+                status_placeholder.empty()
+                full_response = st.write_stream(response_stream)
+                st.session_state.last_stream_stats = stats = response_stream.stats
+                if stats["queue_ms"] is not None: metrics.record("queue_wait", stats["queue_ms"])
+                if stats["ttft_ms"] is not None: metrics.record("ttft", stats["ttft_ms"])
+                metrics.record("stream_total", stats["total_ms"], chars=stats["chars"], updates=stats["updates_out"])
+                if cache_key: response_cache.put(cache_key, full_response, response_stream.stats["total_ms"])
+                if brief_client and st.session_state.get("is_admin"): st.caption(f"🗂️ Client brief: {brief_client}" + ("" if brief_named else " (similar client)"))
+                if retrieved and st.session_state.get("is_admin"):  # operator detail; the timing is also in the retrieval span
+                    sources = sorted({f"{c['source']} p.{c['page']}" for _, c in hits})
+                    st.caption(f"📚 {len(hits)} passages in {retrieval_ms:.1f} ms · {', '.join(sources)}")
             
-            while response_queue.empty() and worker_thread.is_alive():
-                if time.time() - text_update_time > 0.6:
-                    msg = loading_texts[idx % len(loading_texts)]
-                    status_placeholder.markdown(f"<p class='pulsing-text'>🧠 {msg}</p>", unsafe_allow_html=True)
-                    idx += 1
-                    text_update_time = time.time()
-                time.sleep(0.05)
-
-            # 5. STREAM RESPONSE (Once data arrives)
-            status_placeholder.empty()
-            full_response = st.write_stream(queue_to_stream(response_queue))
-            
-            st.session_state.chat_sessions[st.session_state.active_session_id].append({"role": "assistant", "content": full_response})
-            save_to_sheet_background(st.session_state.active_session_id, "assistant", full_response)
+            add_message(st.session_state.active_session_id, "assistant", full_response)
             
         except Exception as e:
             st.error(f"Error: {e}")
 
     # Title Update
-    if st.session_state.session_titles.get(st.session_state.active_session_id) == "New Chat":
-        new_title = get_smart_title(prompt)
-        st.session_state.session_titles[st.session_state.active_session_id] = new_title
-
-
-
+    new_chat = st.session_state.active_session_id not in history.titles
+    if new_chat:
+        new_title = resolve_titles({st.session_state.active_session_id: prompt}, stored={})[st.session_state.active_session_id]
+        history.set_title(st.session_state.active_session_id, new_title)
+
+    # The uploader only resets, and a new chat's title only reaches the sidebar, on a full rerun
+    if up_files or new_chat: st.rerun()
+
+@st.fragment
+def chat_turn(sid, start):
+    # Turns sent since the last full rerun; the history fragment stops at `start`
+    for m in get_session_messages(sid)[start:]: _draw_message(m)
+    if prompt := st.chat_input(f"Innovate here..."): run_turn(prompt)
+
+chat_turn(st.session_state.active_session_id, history_end)
+
+# --- ⚡ RERUN BUDGET ---
+# Wall time of this script run. Replies are generated in the chat_turn fragment, so full runs never include the model
+rerun_ms = (time.perf_counter() - RERUN_STARTED) * 1000
+st.session_state.rerun_times = (st.session_state.get("rerun_times", []) + [rerun_ms])[-50:]
+get_metrics().record("rerun", rerun_ms)
@@ -0,0 +1,609 @@
+"""Offline benchmark: runs app.py against local fakes of Gemini and the Google Sheet.
+
+The real script is driven through streamlit's AppTest, with `google.generativeai`, `gspread` and
+`oauth2client` replaced by in-process fakes that add latency and enforce per-minute quotas (429 +
+retry-after, like the real services). Nothing leaves the machine.
+
+    python benchmark.py                                  # 10k-row sheet, default scenarios
+    python benchmark.py --rows 10000 100000 --turns 10   # several sheet sizes
+    python benchmark.py --out after.json --baseline before.json   # compare two runs
+    python benchmark.py --context-cache --baseline before.json    # the opt-in context cache vs. attaching the KB
+
+Scenarios: cold start (history load), warm rerun, session switch, chat turn (streaming), delete
+session, title generation for an untitled sheet, and knowledge-base load cold/warm. Each reports
+wall-time percentiles and throughput; the app's own timing spans (metrics.jsonl) are broken down
+per stage underneath.
+"""
+import argparse
+import hashlib
+import json
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import types
+from datetime import datetime, timedelta, timezone
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_PATH = os.path.join(APP_DIR, "app.py")
+ASSETS = ["logo.png", "bot_icon.png", "transparent.png", "clients.csv", "studies.pdf", "bible1.pdf", "bible2.pdf"]
+HEADER = ["Timestamp", "Session ID", "Role", "Content"]
+TITLES_HEADER = ["Session ID", "Message Hash", "Title"]
+
+PROMPTS = [
+    "Tealive wants a Merdeka drink for young working adults in Johor. Give me 15 ideas.",
+    "Artisan cafe in Bangsar, hot plant-based drinks for the year-end menu.",
+    "I like Idea 2 and Idea 8, kindly combine these two drink ideas together.",
+    "Finalise Idea 1, Idea 6 and Idea 12 and give me the recipes.",
+]
+REPLY = "\n".join(
+    f"**Idea {i}: Pandan Coconut Cold Brew {i}**\n- Base: cold brew coffee, coconut water\n- Flavour: pandan, gula melaka\n"
+    f"- Topping: salted coconut foam\n- Why it trends: local flavour, photogenic layers, {i * 7} % lower sugar" for i in range(1, 16))
+
+
+# --- FAKE SERVICES ---
+class Quota:
+    """Requests per minute, refilled continuously. Over quota -> the caller gets a 429 with a retry hint."""
+    def __init__(self, per_minute):
+        self.rate = per_minute / 60.0
+        self.capacity = max(per_minute / 6.0, 1.0)  # ~10 s of burst
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+        self.rejected = 0
+
+    def take(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return None
+            self.rejected += 1
+            return (1 - self.tokens) / self.rate
+
+
+class FakeResponse:
+    def __init__(self, status_code, retry_after=None):
+        self.status_code = status_code
+        self.headers = {"Retry-After": f"{retry_after:.2f}"} if retry_after else {}
+
+
+class FakeAPIError(Exception):
+    """Shaped like both gspread's APIError (e.response) and google.api_core errors (e.code)."""
+    def __init__(self, code, retry_after=None):
+        super().__init__(f"{code} quota exceeded, retry in {retry_after or 1:.2f}s")
+        self.code = code
+        self.response = FakeResponse(code, retry_after)
+
+
+class Latency:
+    def __init__(self, scale):
+        self.scale = scale
+
+    def sleep(self, seconds):
+        if seconds > 0 and self.scale > 0: time.sleep(seconds * self.scale * random.uniform(0.8, 1.2))
+
+
+def _col_index(letters):
+    n = 0
+    for ch in letters: n = n * 26 + ord(ch) - 64
+    return n
+
+
+_RANGE = re.compile(r"^(?:[^!]*!)?([A-Z]+)(\d+)?(?::([A-Z]+)(\d+)?)?$")
+
+
+class FakeWorksheet:
+    def __init__(self, service, title, rows, sheet_id):
+        self.service = service
+        self.title = title
+        self.rows = rows
+        self.id = sheet_id
+        self.spreadsheet = service.spreadsheet
+
+    def _range(self, a1):
+        """(first_col, first_row, last_col, last_row), 1-based. Open-ended ranges like "A2:C" run to the last row."""
+        c1, r1, c2, r2 = _RANGE.match(a1).groups()
+        c1, r1 = _col_index(c1), int(r1) if r1 else 1
+        if ":" not in a1: return c1, r1, c1, r1
+        return c1, r1, _col_index(c2) if c2 else c1, int(r2) if r2 else max(len(self.rows), r1)
+
+    def _read(self, a1):
+        c1, r1, c2, r2 = self._range(a1)
+        out = [[cell for cell in (row + [""] * c2)[c1 - 1:c2]] for row in self.rows[r1 - 1:r2]]
+        for row in out:
+            while row and row[-1] == "": row.pop()  # the API leaves out trailing empty cells...
+        while out and not out[-1]: out.pop()       # ...and trailing empty rows
+        return out
+
+    def col_values(self, col):
+        self.service.call(cells=len(self.rows))
+        values = [row[col - 1] if len(row) >= col else "" for row in self.rows]
+        while values and values[-1] == "": values.pop()
+        return values
+
+    def get(self, a1):
+        values = self._read(a1)
+        self.service.call(cells=sum(map(len, values)))
+        return values
+
+    def batch_get(self, ranges):
+        values = [self._read(a1) for a1 in ranges]
+        self.service.call(cells=sum(len(r) for vr in values for r in vr))
+        return values
+
+    def get_all_values(self):
+        self.service.call(cells=sum(map(len, self.rows)))
+        width = max(map(len, self.rows), default=0)
+        return [row + [""] * (width - len(row)) for row in self.rows]
+
+    def append_rows(self, rows):
+        self.service.call(cells=sum(map(len, rows)), write=True)
+        # Like the API, append after the last non-empty row
+        while self.rows and not any(self.rows[-1]): self.rows.pop()
+        start = len(self.rows) + 1
+        self.rows.extend([list(map(str, r)) for r in rows])
+        return {"updates": {"updatedRange": f"'{self.title}'!A{start}:D{len(self.rows)}", "updatedRows": len(rows)}}
+
+    def append_row(self, row):
+        return self.append_rows([row])
+
+    def update(self, values, range_name="A1"):
+        self.batch_update([{"range": range_name, "values": values}])
+
+    def resize(self, rows=None, cols=None):
+        self.service.call(write=True)
+        if rows is not None: del self.rows[rows:]
+
+    def update_title(self, title):
+        self.service.call(write=True)
+        self.spreadsheet.sheets = {(title if t == self.title else t): ws for t, ws in self.spreadsheet.sheets.items()}
+        self.title = title
+
+    def clear(self):
+        self.service.call(write=True)
+        self.rows[:] = []
+
+    def batch_clear(self, ranges):
+        self.service.call(write=True)
+        for a1 in ranges:
+            c1, r1, c2, r2 = self._range(a1)
+            for row in self.rows[r1 - 1:r2]:
+                for c in range(c1 - 1, min(c2, len(row))): row[c] = ""
+
+    def batch_update(self, updates):
+        self.service.call(cells=sum(len(r) for u in updates for r in u["values"]), write=True)
+        for update in updates:
+            c1, r1, _, _ = self._range(update["range"])
+            for offset, values in enumerate(update["values"]):
+                while len(self.rows) < r1 + offset: self.rows.append([])
+                row = self.rows[r1 - 1 + offset]
+                row.extend([""] * (c1 - 1 + len(values) - len(row)))
+                row[c1 - 1:c1 - 1 + len(values)] = [str(v) for v in values]
+
+
+class FakeSpreadsheet:
+    def __init__(self, service):
+        self.service = service
+        self.sheets = {}
+
+    @property
+    def sheet1(self):
+        return next(iter(self.sheets.values()))
+
+    def worksheet(self, title):
+        self.service.call()
+        if title not in self.sheets: raise self.service.module.exceptions.WorksheetNotFound(title)
+        return self.sheets[title]
+
+    def worksheets(self):
+        self.service.call()
+        return list(self.sheets.values())
+
+    def add_worksheet(self, title, rows=100, cols=26, index=None):
+        self.service.call(write=True)
+        ws = FakeWorksheet(self.service, title, [], max((w.id for w in self.sheets.values()), default=-1) + 1)
+        items = list(self.sheets.items())
+        items.insert(len(items) if index is None else index, (title, ws))
+        self.sheets = dict(items)
+        return ws
+
+    def del_worksheet(self, ws):
+        self.service.call(write=True)
+        del self.sheets[ws.title]
+
+    def batch_update(self, body):
+        self.service.call(write=True)
+        by_id = {ws.id: ws for ws in self.sheets.values()}
+        for request in body.get("requests", []):
+            r = request["deleteDimension"]["range"]
+            del by_id[r["sheetId"]].rows[r["startIndex"]:r["endIndex"]]
+
+
+class FakeSheets:
+    """The "JSON 3.0 Logs" spreadsheet plus the gspread / oauth2client modules that hand it out."""
+    def __init__(self, latency, per_minute, base_s=0.08, per_cell_s=2e-6):
+        self.latency = latency
+        self.quota = Quota(per_minute)
+        self.base_s = base_s
+        self.per_cell_s = per_cell_s
+        self.calls = 0
+        self.spreadsheet = FakeSpreadsheet(self)
+        self.module = self._gspread_module()
+
+    def call(self, cells=0, write=False):
+        self.calls += 1
+        wait = self.quota.take()
+        if wait is not None: raise FakeAPIError(429, wait)
+        self.latency.sleep(self.base_s * (1.5 if write else 1) + cells * self.per_cell_s)
+
+    def load(self, rows, titles=None):
+        self.spreadsheet.sheets = {}
+        self.spreadsheet.sheets["Sheet1"] = FakeWorksheet(self, "Sheet1", [list(HEADER)] + rows, 0)
+        if titles is not None:
+            self.spreadsheet.sheets["Titles"] = FakeWorksheet(self, "Titles", [list(TITLES_HEADER)] + titles, 1)
+
+    def _gspread_module(self):
+        gspread = types.ModuleType("gspread")
+        gspread.exceptions = types.SimpleNamespace(WorksheetNotFound=type("WorksheetNotFound", (Exception,), {}),
+                                                   APIError=FakeAPIError)
+        client = types.SimpleNamespace(open=lambda name: self.spreadsheet)
+        gspread.authorize = lambda creds: client
+        return gspread
+
+    @staticmethod
+    def oauth_modules():
+        package = types.ModuleType("oauth2client")
+        package.__path__ = []
+        service_account = types.ModuleType("oauth2client.service_account")
+        service_account.ServiceAccountCredentials = types.SimpleNamespace(from_json_keyfile_dict=lambda info, scope: object())
+        package.service_account = service_account
+        return {"oauth2client": package, "oauth2client.service_account": service_account}
+
+
+class FakeChunk:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeFile:
+    def __init__(self, name, display_name, digest, ready_at):
+        self.name = name
+        self.display_name = display_name
+        self.sha256_hash = bytes.fromhex(digest)
+        self.ready_at = ready_at
+        self.expiration_time = None
+
+    @property
+    def state(self):
+        return types.SimpleNamespace(name="ACTIVE" if time.monotonic() >= self.ready_at else "PROCESSING")
+
+
+class FakeCachedContent:
+    def __init__(self, gemini, model, display_name, ttl):
+        self.gemini = gemini
+        self.name = f"cachedContents/{id(self):x}"
+        self.model, self.display_name = model, display_name
+        self.expire_time = datetime.now(timezone.utc) + ttl
+
+    def update(self, ttl):
+        self.gemini._admit("cache")
+        self.expire_time = datetime.now(timezone.utc) + ttl
+
+    def delete(self):
+        self.gemini._admit("cache")
+        self.gemini.caches.pop(self.name, None)
+
+
+class FakeGemini:
+    """Stands in for the google.generativeai module: models, streaming, the Files API and context caching.
+
+    Time to first token grows with the files attached to a request (file_prefill_s each), so a model bound to a
+    cached context (the KB already server-side) answers faster than one that is sent the KB every turn.
+    """
+    def __init__(self, latency, per_minute, ttft_s=0.6, chunk_s=0.03, chunks=60, title_s=0.25,
+                 upload_s_per_mb=0.05, processing_s=1.0, file_prefill_s=0.3):
+        self.latency = latency
+        self.quota = Quota(per_minute)
+        self.ttft_s, self.chunk_s, self.chunks, self.title_s = ttft_s, chunk_s, chunks, title_s
+        self.upload_s_per_mb, self.processing_s, self.file_prefill_s = upload_s_per_mb, processing_s, file_prefill_s
+        self.files = {}
+        self.caches = {}
+        self.counts = {"generate": 0, "stream": 0, "upload": 0, "get_file": 0, "cache": 0}
+        self.lock = threading.Lock()
+        self.module = self._module()
+
+    def _admit(self, kind):
+        with self.lock: self.counts[kind] += 1
+        wait = self.quota.take()
+        if wait is not None: raise FakeAPIError(429, wait)
+
+    def generate(self, contents, stream=False):
+        if not stream:
+            self._admit("generate")
+            self.latency.sleep(self.title_s)
+            text = contents if isinstance(contents, str) else json.dumps(contents, default=str)
+            return FakeChunk(f"Fake Title {hashlib.sha1(text.encode()).hexdigest()[:6]}")
+        self._admit("stream")
+        files = sum(isinstance(p, FakeFile) for m in contents if isinstance(m, dict) for p in m.get("parts", []))
+        return self._stream(self.ttft_s + files * self.file_prefill_s)
+
+    def _stream(self, ttft_s):
+        self.latency.sleep(ttft_s)
+        size = -(-len(REPLY) // self.chunks)
+        for i in range(0, len(REPLY), size):
+            yield FakeChunk(REPLY[i:i + size])
+            self.latency.sleep(self.chunk_s)
+
+    def upload_file(self, path, display_name=None):
+        self._admit("upload")
+        with open(path, "rb") as f: digest = hashlib.sha256(f.read()).hexdigest()
+        self.latency.sleep(os.path.getsize(path) / 1e6 * self.upload_s_per_mb)
+        ref = FakeFile(f"files/{digest[:12]}{len(self.files)}", display_name or os.path.basename(path), digest,
+                       time.monotonic() + self.processing_s * self.latency.scale)
+        self.files[ref.name] = ref
+        return ref
+
+    def get_file(self, name):
+        self._admit("get_file")
+        self.latency.sleep(0.05)
+        if name not in self.files: raise FakeAPIError(404)
+        return self.files[name]
+
+    def _module(self):
+        gemini = self
+        genai = types.ModuleType("google.generativeai")
+
+        class GenerativeModel:
+            def __init__(self, name, system_instruction=None):
+                self.name, self.system_instruction = name, system_instruction
+
+            def generate_content(self, contents, stream=False):
+                return gemini.generate(contents, stream)
+
+            @classmethod
+            def from_cached_content(cls, cached_content):
+                return cls(cached_content.model)
+
+        class CachedContent:
+            @staticmethod
+            def list():
+                gemini._admit("cache")
+                return list(gemini.caches.values())
+
+            @staticmethod
+            def create(model, display_name=None, system_instruction=None, contents=None, ttl=timedelta(hours=1)):
+                gemini._admit("cache")
+                gemini.latency.sleep(gemini.file_prefill_s * sum(isinstance(p, FakeFile) for m in contents or [] for p in m.get("parts", [])))
+                cached = FakeCachedContent(gemini, model, display_name, ttl)
+                gemini.caches[cached.name] = cached
+                return cached
+
+        genai.GenerativeModel = GenerativeModel
+        genai.caching = types.SimpleNamespace(CachedContent=CachedContent)
+        genai.configure = lambda api_key=None, **kwargs: None
+        genai.upload_file = self.upload_file
+        genai.get_file = self.get_file
+        genai.list_files = lambda: list(self.files.values())
+        genai.delete_file = lambda name: self.files.pop(name, None)
+        return genai
+
+
+def install_fakes(sheets, gemini):
+    """Makes `import google.generativeai`, `import gspread` and oauth2client resolve to the fakes."""
+    try: import google
+    except ImportError:
+        google = types.ModuleType("google")
+        google.__path__ = []
+        sys.modules["google"] = google
+    google.generativeai = gemini.module
+    sys.modules["google.generativeai"] = gemini.module
+    sys.modules["gspread"] = sheets.module
+    sys.modules.update(FakeSheets.oauth_modules())
+
+
+# --- DATA ---
+def make_history(rows, msgs_per_session, titled=True):
+    """Interleaved sessions, like a sheet many users write to at once. Returns (log rows, title rows)."""
+    sessions = max(rows // msgs_per_session, 1)
+    log, titles, start = [], [], time.time() - 30 * 86400
+    turn = [0] * sessions
+    for i in range(rows):
+        s = random.randrange(sessions)
+        role = "user" if turn[s] % 2 == 0 else "assistant"
+        content = PROMPTS[turn[s] // 2 % len(PROMPTS)] if role == "user" else REPLY
+        ts = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(start + i * 30))
+        log.append([ts, f"Session {s + 1}", role, content])
+        turn[s] += 1
+    if titled:
+        for s in range(sessions):
+            first = PROMPTS[0]
+            titles.append([f"Session {s + 1}", hashlib.sha1(first.encode("utf-8")).hexdigest()[:16], f"Bench Chat {s + 1}"])
+    return log, (titles if titled else None)
+
+
+# --- HARNESS ---
+def percentiles(values):
+    values = sorted(values)
+    if not values: return {"n": 0}
+    pick = lambda q: values[min(len(values) - 1, int(len(values) * q))]
+    total = sum(values)
+    return {"n": len(values), "p50": pick(0.5), "p95": pick(0.95), "p99": pick(0.99), "mean": total / len(values),
+            "ops_per_s": len(values) / (total / 1000) if total else None}
+
+
+class Bench:
+    def __init__(self, args, workdir):
+        self.args = args
+        self.workdir = workdir
+        self.latency = Latency(args.latency_scale)
+        self.sheets = FakeSheets(self.latency, args.sheets_rpm)
+        self.gemini = FakeGemini(self.latency, args.gemini_rpm)
+        self.metrics_path = os.path.join(workdir, "metrics.jsonl")
+        self.results, self.stages = {}, {}
+        install_fakes(self.sheets, self.gemini)
+        if APP_DIR not in sys.path: sys.path.insert(0, APP_DIR)
+
+    def clear_caches(self):
+        import streamlit as st
+        st.cache_resource.clear()
+        st.cache_data.clear()
+
+    def app(self):
+        from streamlit.testing.v1 import AppTest
+        at = AppTest.from_file(APP_PATH, default_timeout=self.args.timeout)
+        at.secrets["APP_PASSWORD"] = "bench"
+        at.secrets["GEMINI_API_KEY"] = "bench"
+        at.secrets["gcp_service_account"] = {"type": "service_account", "client_email": "bench@example.com"}
+        at.secrets["METRICS_PATH"] = self.metrics_path
+        at.secrets["SHEETS_RPS"] = self.args.sheets_rpm / 60.0
+        at.secrets["GEMINI_RPS"] = self.args.gemini_rpm / 60.0
+        at.secrets["CONTEXT_CACHE"] = self.args.context_cache
+        at.secrets["LOG_ROTATE_ROWS"] = 10 ** 9  # the scenarios measure one log worksheet of --rows rows
+        at.session_state["password_correct"] = True
+        return at
+
+    def timed(self, scenario, action):
+        """Runs action() (one AppTest rerun or more) and books its wall time and the spans it produced."""
+        offset = os.path.getsize(self.metrics_path) if os.path.exists(self.metrics_path) else 0
+        started = time.perf_counter()
+        at = action()
+        elapsed = (time.perf_counter() - started) * 1000
+        if at is not None and (at.exception or at.error):
+            problems = [e.value for e in at.exception] + [e.value for e in at.error]
+            raise SystemExit(f"{scenario}: app reported {problems[:3]}")
+        self.results.setdefault(scenario, []).append(elapsed)
+        if os.path.exists(self.metrics_path):
+            with open(self.metrics_path, encoding="utf-8") as f:
+                f.seek(offset)
+                for line in f:
+                    try: span = json.loads(line)
+                    except ValueError: continue
+                    self.stages.setdefault(scenario, {}).setdefault(span["stage"], []).append(span["ms"])
+        return at
+
+    # --- SCENARIOS ---
+    def history(self, rows):
+        tag = f"{rows // 1000}k"
+        log, titles = make_history(rows, self.args.msgs_per_session)
+        self.sheets.load(log, titles)
+        self.clear_caches()
+        at = self.app()
+        at = self.timed(f"cold_start[{tag}]", at.run)
+        for _ in range(self.args.reruns): self.timed(f"warm_rerun[{tag}]", at.run)
+        for _ in range(self.args.reruns):
+            button = random.choice([b for b in at.sidebar.button if (b.key or "").startswith("btn_")])
+            at = self.timed(f"switch_session[{tag}]", button.click().run)
+        for i in range(self.args.turns):
+            at = self.timed(f"chat_turn[{tag}]", at.chat_input[0].set_value(PROMPTS[i % len(PROMPTS)]).run)
+        for _ in range(self.args.deletes):
+            delete = next(b for b in at.sidebar.button if b.label == "🗑️ Delete Chat")
+            at = delete.click().run()
+            confirm = next(b for b in at.sidebar.button if b.label == "✅ Yes")
+            at = self.timed(f"delete_session[{tag}]", confirm.click().run)
+
+    def titles(self):
+        log, _ = make_history(self.args.title_sessions * self.args.msgs_per_session, self.args.msgs_per_session, titled=False)
+        self.sheets.load(log, None)
+        self.clear_caches()
+        self.timed(f"title_generation[{self.args.title_sessions} sessions]", self.app().run)
+
+    def knowledge_base(self):
+        manifest = os.path.join(self.workdir, ".kb_manifest.json")
+        log, titles = make_history(200, self.args.msgs_per_session)
+        for _ in range(self.args.kb_repeats):
+            self.sheets.load(log, titles)
+            self.gemini.files.clear()
+            if os.path.exists(manifest): os.remove(manifest)
+            self.clear_caches()
+            self.timed("kb_load_cold", self.app().run)
+            self.clear_caches()
+            self.timed("kb_load_warm", self.app().run)
+
+    def run(self):
+        for rows in self.args.rows: self.history(rows)
+        if self.args.title_sessions: self.titles()
+        if self.args.kb_repeats: self.knowledge_base()
+        return {
+            "config": {k: v for k, v in vars(self.args).items() if k not in ("out", "baseline")},
+            "scenarios": {name: percentiles(values) for name, values in self.results.items()},
+            "stages": {name: {stage: percentiles(v) for stage, v in sorted(stages.items())} for name, stages in self.stages.items()},
+            "fakes": {"sheets_calls": self.sheets.calls, "sheets_429": self.sheets.quota.rejected,
+                      "gemini_calls": dict(self.gemini.counts), "gemini_429": self.gemini.quota.rejected},
+        }
+
+
+# --- REPORT ---
+def _fmt(ms):
+    return "-" if ms is None else (f"{ms / 1000:.2f}s" if ms >= 1000 else f"{ms:.1f}ms")
+
+
+def report(result, baseline=None):
+    base = (baseline or {}).get("scenarios", {})
+    print(f"{'scenario':34} {'n':>4} {'p50':>9} {'p95':>9} {'p99':>9} {'ops/s':>8}  vs baseline p50/p95")
+    for name, p in result["scenarios"].items():
+        delta = ""
+        if name in base and base[name].get("p50"):
+            delta = "  " + " / ".join(f"{(p[k] - base[name][k]) / base[name][k]:+.0%}" for k in ("p50", "p95"))
+        ops = f"{p['ops_per_s']:.2f}" if p.get("ops_per_s") else "-"
+        print(f"{name:34} {p['n']:>4} {_fmt(p.get('p50')):>9} {_fmt(p.get('p95')):>9} {_fmt(p.get('p99')):>9} {ops:>8}{delta}")
+        for stage, s in result["stages"].get(name, {}).items():
+            print(f"    {stage:30} {s['n']:>4} {_fmt(s.get('p50')):>9} {_fmt(s.get('p95')):>9}")
+    fakes = result["fakes"]
+    print(f"\nfake sheets: {fakes['sheets_calls']} calls, {fakes['sheets_429']} throttled (429) · "
+          f"fake gemini: {fakes['gemini_calls']}, {fakes['gemini_429']} throttled (429)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, nargs="+", default=[10000], help="sheet sizes to load (rows)")
+    parser.add_argument("--msgs-per-session", type=int, default=20)
+    parser.add_argument("--reruns", type=int, default=10, help="warm reruns and session switches per sheet size")
+    parser.add_argument("--turns", type=int, default=5, help="chat turns per sheet size")
+    parser.add_argument("--deletes", type=int, default=3, help="session deletes per sheet size")
+    parser.add_argument("--title-sessions", type=int, default=100, help="untitled sessions for the title scenario (0 to skip)")
+    parser.add_argument("--kb-repeats", type=int, default=3, help="cold/warm knowledge-base loads (0 to skip)")
+    parser.add_argument("--kb-mb", type=float, default=5.0, help="size of stand-in PDFs for KB files missing locally")
+    parser.add_argument("--latency-scale", type=float, default=0.25, help="multiplier on simulated service latency (0 = none)")
+    parser.add_argument("--sheets-rpm", type=int, default=300, help="fake Sheets quota, requests per minute")
+    parser.add_argument("--gemini-rpm", type=int, default=600, help="fake Gemini quota, requests per minute")
+    parser.add_argument("--context-cache", action="store_true", help="run with CONTEXT_CACHE on (KB cached server-side)")
+    parser.add_argument("--timeout", type=float, default=600, help="AppTest timeout per rerun (s)")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--out", help="write the results as JSON")
+    parser.add_argument("--baseline", help="JSON from an earlier run to compare against")
+    args = parser.parse_args(argv)
+    random.seed(args.seed)
+
+    workdir = tempfile.mkdtemp(prefix="json3-bench-")
+    cwd = os.getcwd()
+    try:
+        # The app reads its assets and writes its manifest/metrics relative to the working directory
+        for name in ASSETS:
+            src = os.path.join(APP_DIR, name)
+            if os.path.exists(src): os.symlink(src, os.path.join(workdir, name))
+            elif name.endswith(".pdf"):
+                with open(os.path.join(workdir, name), "wb") as f: f.write(os.urandom(int(args.kb_mb * 1e6)))
+        os.chdir(workdir)
+        result = Bench(args, workdir).run()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f: baseline = json.load(f)
+    report(result, baseline)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f: json.dump(result, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,175 @@
+"""Bulk export and import of the chat log.
+
+An export is a zip holding manifest.json (format, row counts per session, titles) plus the rows in one format:
+
+    chats.jsonl      one {"timestamp", "session_id", "role", "content"} object per line, in log order
+    chats.csv        the log's own columns (Timestamp, Session ID, Role, Content), in log order
+    sessions/*.md    one readable transcript per session (export only; Markdown can't be imported back)
+
+Rows are pulled from the store a batch at a time (ChatStore.iter_rows) and written straight into the zip on
+disk, so an export never holds the whole log in memory. import_zip() reads JSONL and CSV exports back and
+appends the rows the store doesn't have yet, in batches.
+"""
+import csv
+import hashlib
+import io
+import json
+import os
+import re
+import tempfile
+import zipfile
+from datetime import datetime
+
+FORMATS = {"jsonl": "chats.jsonl", "csv": "chats.csv", "md": "sessions/"}
+COLUMNS = ["Timestamp", "Session ID", "Role", "Content"]
+KEYS = ["timestamp", "session_id", "role", "content"]
+BATCH_ROWS = 500
+
+
+def _file_name(sid, taken):
+    name = re.sub(r"[^\w.-]+", "_", sid).strip("_") or "session"
+    candidate, n = name, 1
+    while candidate in taken:
+        n += 1
+        candidate = f"{name}_{n}"
+    taken.add(candidate)
+    return f"{FORMATS['md']}{candidate}.md"
+
+
+def _markdown(sid, title, batches):
+    yield f"# {title or sid}\n\n_Session: {sid}_\n\n"
+    for rows in batches:
+        for ts, _, role, content in rows:
+            yield f"**{'AI' if role == 'assistant' else 'USER'}** · {ts}\n\n{content}\n\n---\n\n"
+
+
+def _counted(batches, counts):
+    for rows in batches:
+        for row in rows: counts[row[1]] = counts.get(row[1], 0) + 1
+        yield rows
+
+
+def export_zip(store, fmt="jsonl", session_ids=None, path=None, batch=BATCH_ROWS):
+    """Writes all sessions (or just `session_ids`) to a zip at `path`, a new temp file by default.
+
+    Returns (path, manifest). The caller owns the file.
+    """
+    if fmt not in FORMATS: raise ValueError(f"unknown export format {fmt!r}; expected one of {', '.join(FORMATS)}")
+    if path is None:
+        fd, path = tempfile.mkstemp(prefix="chat_export_", suffix=".zip")
+        os.close(fd)
+    titles, counts = store.load_titles(), {}
+    wanted = list(session_ids) if session_ids is not None else None
+    try:
+        with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as zf:
+            if fmt == "md":
+                taken = set()
+                for sid in (wanted if wanted is not None else store.list_sessions()):
+                    with io.TextIOWrapper(zf.open(_file_name(sid, taken), "w"), encoding="utf-8", newline="") as out:
+                        out.writelines(_markdown(sid, titles.get(sid, ("", ""))[1], _counted(store.iter_rows([sid], batch), counts)))
+            else:
+                with io.TextIOWrapper(zf.open(FORMATS[fmt], "w"), encoding="utf-8", newline="") as out:
+                    writer = csv.writer(out) if fmt == "csv" else None
+                    if writer: writer.writerow(COLUMNS)
+                    for rows in _counted(store.iter_rows(wanted, batch), counts):
+                        if writer: writer.writerows(rows)
+                        else: out.writelines(json.dumps(dict(zip(KEYS, row)), ensure_ascii=False) + "\n" for row in rows)
+            manifest = {"format": fmt, "created": datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "rows": sum(counts.values()),
+                        "sessions": counts, "titles": {sid: list(titles[sid]) for sid in counts if sid in titles}}
+            zf.writestr("manifest.json", json.dumps(manifest, ensure_ascii=False, indent=1))
+    except BaseException:
+        os.remove(path)
+        raise
+    return path, manifest
+
+
+def _jsonl_rows(f):
+    for line in f:
+        if not line.strip(): continue
+        record = json.loads(line)
+        yield [str(record.get(k, "")) for k in KEYS]
+
+
+def _csv_rows(f):
+    reader = csv.reader(f)
+    next(reader, None)
+    for row in reader:
+        yield (row + [""] * 4)[:4]
+
+
+def read_rows(zf):
+    """Yields the [timestamp, session_id, role, content] rows of an open export, one at a time."""
+    names = set(zf.namelist())
+    member = next((FORMATS[f] for f in ("jsonl", "csv") if FORMATS[f] in names), None)
+    if member is None: raise ValueError("no chats.jsonl or chats.csv in this zip (Markdown exports can't be imported)")
+    with io.TextIOWrapper(zf.open(member), encoding="utf-8", newline="") as f:
+        for row in (_jsonl_rows(f) if member.endswith(".jsonl") else _csv_rows(f)):
+            if row[1]: yield row
+
+
+def _row_key(row):
+    # A row is the same row if its timestamp, role and content match, whatever session ID it was filed under
+    return row[0], row[2], hashlib.sha1(row[3].encode("utf-8")).hexdigest()
+
+
+def _session_num(sid):
+    m = re.fullmatch(r"Session (\d+)", sid)
+    return int(m.group(1)) if m else 0
+
+
+def import_zip(store, source, batch=BATCH_ROWS, new_session_id=None, reserved=0):
+    """Appends the rows of a JSONL or CSV export (a path or file object) to `store`, `batch` rows per write.
+
+    Rows the store already holds are skipped, so importing an export twice (or again after an interrupted
+    import) is harmless. Session IDs are per-deployment counters: an exported session goes to the session that
+    already holds some of its rows, else keeps its ID if the store doesn't use it and its number is above
+    `reserved` (IDs handed out but not written yet, e.g. empty draft sessions), else gets a new ID from
+    `new_session_id()` (default: the next free "Session N"). Manifest titles follow their sessions.
+    Returns {"rows", "sessions", "skipped", "renamed"} (skipped counts rows; renamed maps exported IDs to the
+    new IDs they were stored under).
+    """
+    existing = {}
+    for rows in store.iter_rows(batch=batch):
+        for row in rows: existing[_row_key(row)] = row[1]
+    with zipfile.ZipFile(source) as zf:
+        manifest = json.loads(zf.read("manifest.json")) if "manifest.json" in zf.namelist() else {}
+        # First pass: where each exported session goes
+        exported, matched = {}, {}
+        for row in read_rows(zf):
+            exported[row[1]] = None
+            if _row_key(row) in existing: matched.setdefault(row[1], existing[_row_key(row)])
+        used = set(existing.values())
+        target = {sid: matched.get(sid, sid) for sid in exported
+                  if sid in matched or (sid not in used and not 0 < _session_num(sid) <= reserved)}
+        if new_session_id is None:
+            last = max([reserved] + [_session_num(sid) for sid in used | set(exported)])
+            def new_session_id():
+                nonlocal last
+                last += 1
+                return f"Session {last}"
+        taken, renamed = used | set(target.values()), {}
+        for sid in exported:
+            if sid in target: continue
+            new = new_session_id()
+            while new in taken: new = new_session_id()
+            taken.add(new)
+            target[sid] = renamed[sid] = new
+        # Second pass: append what's missing
+        imported, skipped, pending, rows = set(), 0, [], 0
+        for row in read_rows(zf):
+            if _row_key(row) in existing:
+                skipped += 1
+                continue
+            imported.add(target[row[1]])
+            pending.append([row[0], target[row[1]], row[2], row[3]])
+            if len(pending) >= batch:
+                store.append_rows(pending)
+                rows += len(pending)
+                pending = []
+        if pending:
+            store.append_rows(pending)
+            rows += len(pending)
+    titles = [(target[sid], msg_hash, title) for sid, (msg_hash, title) in manifest.get("titles", {}).items() if target.get(sid) in imported]
+    if titles: store.save_titles(titles)
+    return {"rows": rows, "sessions": len(imported), "skipped": skipped, "renamed": renamed}
+
@@ -0,0 +1,609 @@
+"""Chat log storage: the ChatStore interface and its Google Sheets and SQLite backends.
+
+The app picks one in connect_to_db() (STORAGE_BACKEND = "sheets" or "sqlite"). Both keep the log as rows of
+[timestamp, session_id, role, content] and stored session titles alongside it.
+"""
+import hashlib
+import re
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta
+
+LOG_HEADER = ["Timestamp", "Session ID", "Role", "Content"]
+TITLES_HEADER = ["Session ID", "Message Hash", "Title"]
+INDEX_HEADER = ["Session ID", "Worksheet", "Rows", "Count", "Updated"]
+ARCHIVE_PREFIX = "Archive "
+ROTATED_MARKER = "(rotated)"
+LOG_ROTATE_ROWS = 20000
+LOG_ROTATE_DAYS = 31
+
+
+class ChatStore(ABC):
+    """Storage interface for the chat log. A row is [timestamp, session_id, role, content]."""
+    @abstractmethod
+    def append_rows(self, rows, retries=None):
+        """retries overrides the API guard's retry count for the write itself (backends behind one)."""
+    @abstractmethod
+    def load_all(self): ...
+    @abstractmethod
+    def read_index(self):
+        """Light full read: ({session_id: {"updated": ts, "count": n}} in first-seen order, cursor). No message bodies."""
+    @abstractmethod
+    def read_since(self, cursor):
+        """Returns (new_rows, new_cursor), or None when a wipe/delete invalidated the cursor (call read_index again)."""
+    @abstractmethod
+    def load_session(self, session_id): ...
+    @abstractmethod
+    def list_sessions(self): ...
+    @abstractmethod
+    def delete_session(self, session_id): ...
+    @abstractmethod
+    def wipe(self): ...
+    @abstractmethod
+    def load_titles(self):
+        """Returns {session_id: (message_hash, title)}."""
+    @abstractmethod
+    def save_titles(self, entries): ...
+    def first_user_messages(self, session_ids):
+        """{session_id: text of its first user message}. Sessions may be left out; callers load those in full."""
+        out = {}
+        for sid in session_ids:
+            text = next((row[3] for row in self.load_session(sid) if row[2] == "user"), None)
+            if text is not None: out[sid] = text
+        return out
+    def compact(self):
+        """Reclaims space left by deleted rows. Returns the number of rows reclaimed."""
+        return 0
+    def iter_rows(self, session_ids=None, batch=500):
+        """Yields lists of at most `batch` rows, in log order, of all sessions or just `session_ids` (for exports)."""
+        wanted = set(session_ids) if session_ids is not None else None
+        rows = [row for row in self.load_all() if wanted is None or row[1] in wanted]
+        for i in range(0, len(rows), batch): yield rows[i:i + batch]
+
+
+class SheetStore(ChatStore):
+    """The "JSON 3.0 Logs" Google Sheet.
+
+    New rows go to the first worksheet (the active log). Once it holds `rotate_rows` rows or was started
+    `rotate_days` ago, it is renamed to an "Archive ..." worksheet and a fresh active log takes its place. The
+    "Index" worksheet has one row per (session, archive) -- [session, worksheet, row ranges, count, updated] --
+    so listing sessions and loading one never scan the archives; a row with neither session nor worksheet records
+    when the active log was started. Deleting from an archive clears the rows and
+    tombstones the index row (count 0); compact() squeezes the gaps out later.
+
+    For the active log it keeps an index of row ranges per session ({sid: [[first_row, last_row], ...]}, 1-based
+    sheet rows) so single-session reads and deletes only touch that session's rows.
+    """
+    def __init__(self, ws, guard=None, rotate_rows=LOG_ROTATE_ROWS, rotate_days=LOG_ROTATE_DAYS):
+        self.ws = ws
+        self.guard = guard
+        self.rotate_rows = rotate_rows
+        self.rotate_days = rotate_days
+        self.lock = threading.RLock()
+        self._index = None
+        self._titles = None
+        self._title_rows = None
+        self._index_ws = None
+        self._archived = None      # {sid: [{"row", "worksheet", "ranges", "count", "updated"}]}, from the Index worksheet
+        self._archive_ws = {}
+        self._active_since = None  # when the active log was started, from the Index
+
+    def _call(self, fn, *args, retries=None, **kwargs):
+        return self.guard.call("sheets", fn, *args, max_retries=retries, **kwargs) if self.guard else fn(*args, **kwargs)
+
+    def _worksheet(self, title, header):
+        import gspread
+        try: return self._call(self.ws.spreadsheet.worksheet, title)
+        except gspread.exceptions.WorksheetNotFound:
+            ws = self._call(self.ws.spreadsheet.add_worksheet, title, rows=100, cols=len(header))
+            self._call(ws.append_row, header)
+            return ws
+
+    # --- ROW-RANGE INDEX (ACTIVE LOG) ---
+    def _build_index(self):
+        index = {}
+        for row_num, sid in enumerate(self._call(self.ws.col_values, 2)[1:], start=2):
+            if sid: self._add_row(index, sid, row_num)
+        self._index = index
+
+    @staticmethod
+    def _add_row(index, sid, row_num):
+        ranges = index.setdefault(sid, [])
+        if ranges and row_num <= ranges[-1][1]: return  # already indexed (our own append, read back by a delta sync)
+        if ranges and ranges[-1][1] == row_num - 1: ranges[-1][1] = row_num
+        else: ranges.append([row_num, row_num])
+
+    def _fetch_ranges(self, session_id, cols):
+        """Reads the session's ranges, rebuilding the index once if the sheet was changed behind our back."""
+        for attempt in range(2):
+            if self._index is None or attempt: self._build_index()
+            ranges = self._index.get(session_id, [])
+            if not ranges:
+                if attempt: return [], []
+                continue
+            values = self._call(self.ws.batch_get, [f"{cols[0]}{start}:{cols[1]}{end}" for start, end in ranges])
+            sid_col = 1 if cols[0] == "A" else 0
+            if all(len(vr) == end - start + 1 and all(len(r) > sid_col and r[sid_col] == session_id for r in vr)
+                   for vr, (start, end) in zip(values, ranges)):
+                return ranges, values
+        return [], []
+
+    def _forget_ranges(self, session_id, deleted):
+        self._index.pop(session_id, None)
+        for ranges in self._index.values():
+            for r in ranges:
+                shift = sum(end - start + 1 for start, end in deleted if end < r[0])
+                r[0] -= shift; r[1] -= shift
+
+    # --- ARCHIVES ---
+    @staticmethod
+    def _format_ranges(ranges):
+        return ";".join(f"{start}-{end}" for start, end in ranges)
+
+    @staticmethod
+    def _parse_ranges(text):
+        return [[int(a), int(b)] for a, b in (part.split("-") for part in text.split(";") if part)]
+
+    def _index_sheet(self):
+        if self._index_ws is None: self._index_ws = self._worksheet("Index", INDEX_HEADER)
+        return self._index_ws
+
+    def _load_archived(self):
+        archived, started = {}, ""
+        for row_num, row in enumerate(self._call(self._index_sheet().get_all_values)[1:], start=2):
+            sid, title, ranges, count, updated = (list(row) + [""] * 5)[:5]
+            if not title:
+                if not sid: started = max(started, updated)
+                continue
+            archived.setdefault(sid, []).append({"row": row_num, "worksheet": title, "ranges": self._parse_ranges(ranges),
+                                                 "count": int(count or 0), "updated": updated})
+        self._archived = archived
+        self._active_since = started or None
+        return archived
+
+    def _archive(self, title):
+        if title not in self._archive_ws: self._archive_ws[title] = self._call(self.ws.spreadsheet.worksheet, title)
+        return self._archive_ws[title]
+
+    def _fetch_archived(self, session_id, cols):
+        """[(index entry, [(row_num, row), ...])] of the session's archive rows, read against a fresh Index.
+
+        Other processes compact archives in place, so every fetched row is checked to still belong to the session
+        (as _fetch_ranges does for the active log). On a mismatch the Index is read again once; rows that still
+        don't match are left out.
+        """
+        sid_col = 1 if cols[0] == "A" else 0
+        for attempt in range(2):
+            fetched, moved = [], False
+            for entry in self._load_archived().get(session_id, []):
+                rows = []
+                if entry["count"]:
+                    values = self._call(self._archive(entry["worksheet"]).batch_get, [f"{cols[0]}{s}:{cols[1]}{e}" for s, e in entry["ranges"]])
+                    for vr, (start, end) in zip(values, entry["ranges"]):
+                        moved |= len(vr) != end - start + 1
+                        for row_num, row in enumerate(vr, start=start):
+                            if len(row) > sid_col and row[sid_col] == session_id: rows.append((row_num, row))
+                            else: moved = True
+                fetched.append((entry, rows))
+            if not moved: break
+        return fetched
+
+    def _refresh_active(self, ws=None):
+        # The log was rotated by another process: our worksheet handle now points at an archive
+        self.ws = ws or self._call(lambda: self.ws.spreadsheet.sheet1)
+        self._index, self._archived, self._active_since = None, None, None
+
+    def _mark_started(self):
+        self._active_since = f"{datetime.now():%Y-%m-%d %H:%M:%S}"
+        self._call(self._index_sheet().append_row, ["", "", "", 0, self._active_since])
+
+    def _due_for_rotation(self, rows):
+        # Age counts from when the log was started, not from row timestamps: imported rows carry their old ones
+        if rows >= self.rotate_rows: return True
+        if self._active_since is None: self._load_archived()
+        if self._active_since is None: self._mark_started()  # a log from before start times were recorded
+        try: started = datetime.strptime(self._active_since, "%Y-%m-%d %H:%M:%S")
+        except ValueError: return False
+        return datetime.now() - started > timedelta(days=self.rotate_days)
+
+    @classmethod
+    def _scan(cls, values):
+        """({sid: row ranges}, {sid: {"count", "updated"}}) of a log's rows, `values` starting at sheet row 2."""
+        ranges, meta = {}, {}
+        for row_num, row in enumerate(values, start=2):
+            ts, sid, _ = (list(row) + [""] * 3)[:3]
+            if not sid: continue
+            cls._add_row(ranges, sid, row_num)
+            m = meta.setdefault(sid, {"count": 0, "updated": ""})
+            m["count"] += 1
+            m["updated"] = max(m["updated"], ts)
+        return ranges, meta
+
+    def _archive_log(self, ws, values, taken):
+        """Marks `ws` rotated, renames it to a new archive title (added to `taken`) and indexes its sessions."""
+        ranges, meta = self._scan(values)
+        archive_title = f"{ARCHIVE_PREFIX}{datetime.now():%Y-%m-%d %H:%M:%S}"
+        while archive_title in taken: archive_title += "'"
+        taken.add(archive_title)
+        # Readers holding a delta cursor on the old log see this row and look for the new one
+        self._call(ws.append_row, ["", "", ROTATED_MARKER, archive_title])
+        self._call(ws.update_title, archive_title)
+        if meta:
+            self._call(self._index_sheet().append_rows,
+                       [[sid, archive_title, self._format_ranges(ranges[sid]), m["count"], m["updated"]] for sid, m in meta.items()])
+        self._archive_ws[archive_title] = ws
+        self._archived = None
+
+    def _adopt_orphans(self, worksheets):
+        """Archives logs a failed rotation left behind: worksheets after the active log that still have the log
+        header but no archive title (it failed between inserting the new log and renaming the old one)."""
+        active, taken = worksheets[0], {ws.title for ws in worksheets}
+        for ws in worksheets[1:]:
+            if ws.title in ("Index", "Titles") or ws.title.startswith(ARCHIVE_PREFIX): continue
+            if [list(r) for r in self._call(ws.get, "A1:D1")] != [LOG_HEADER]: continue
+            taken.discard(ws.title)
+            self._archive_log(ws, self._call(ws.get, "A2:C"), taken)
+        # The log that replaced it may still carry its temporary name
+        if active.title.endswith(" (new)") and active.title[:-len(" (new)")] not in taken:
+            self._call(active.update_title, active.title[:-len(" (new)")])
+
+    def rotate(self):
+        """Renames the active log to a dated archive, indexes its sessions and starts a fresh log in its place.
+
+        Runs inside append_rows on the writer thread, so it does nothing else: compact() is left to the caller's
+        schedule. Logs an earlier failed rotation left behind are archived first.
+        """
+        with self.lock:
+            worksheets = self._call(self.ws.spreadsheet.worksheets)
+            if worksheets[0].id != self.ws.id:
+                self._refresh_active(worksheets[0])
+                return False
+            self._adopt_orphans(worksheets)
+            values = self._call(self.ws.get, "A2:C")
+            if not any(len(row) > 1 and row[1] for row in values): return False
+            active_title = self.ws.title
+            fresh = self._call(self.ws.spreadsheet.add_worksheet, f"{active_title} (new)", rows=1000, cols=len(LOG_HEADER), index=0)
+            self._call(fresh.append_row, LOG_HEADER)
+            self._mark_started()
+            self._archive_log(self.ws, values, {ws.title for ws in worksheets} | set(self._archive_ws))
+            self._call(fresh.update_title, active_title)
+            started = self._active_since
+            self._refresh_active(fresh)
+            self._index, self._active_since = {}, started
+        return True
+
+    def compact(self):
+        """Rewrites archives that hold deleted rows, drops empty ones and indexes archives the Index doesn't know.
+        Logs a failed rotation left behind are archived first.
+
+        Returns the number of rows reclaimed.
+        """
+        with self.lock:
+            worksheets = self._call(self.ws.spreadsheet.worksheets)
+            if worksheets[0].id != self.ws.id: self._refresh_active(worksheets[0])
+            self._adopt_orphans(worksheets)
+            archived = self._load_archived()
+            entries = sorted(({**e, "sid": sid} for sid, es in archived.items() for e in es), key=lambda e: e["row"])
+            known = list(dict.fromkeys(e["worksheet"] for e in entries))
+            present = {ws.title: ws for ws in worksheets if ws.title.startswith(ARCHIVE_PREFIX)}
+            dirty = {e["worksheet"] for e in entries if not e["count"]} | {t for t in present if t not in known}
+            if not dirty and all(t in present for t in known): return 0
+            reclaimed, index_rows = 0, []
+            for title in known + sorted(t for t in present if t not in known):
+                ws = present.get(title)
+                if ws is None: continue  # archive removed by hand: drop its index rows
+                if title not in dirty:
+                    index_rows += [[e["sid"], title, self._format_ranges(e["ranges"]), e["count"], e["updated"]] for e in entries if e["worksheet"] == title]
+                    continue
+                values = self._call(ws.get_all_values)[1:]
+                kept = [(list(r) + [""] * 4)[:4] for r in values if len(r) > 1 and r[1]]
+                reclaimed += len(values) - len(kept)
+                if not kept:
+                    self._call(self.ws.spreadsheet.del_worksheet, ws)
+                    self._archive_ws.pop(title, None)
+                    continue
+                # Overwrite in place, then cut the tail: the rows are never missing from the sheet
+                self._call(ws.update, values=[LOG_HEADER] + kept, range_name="A1")
+                self._call(ws.resize, rows=len(kept) + 1)
+                ranges, meta = self._scan(kept)
+                index_rows += [[sid, title, self._format_ranges(ranges[sid]), m["count"], m["updated"]] for sid, m in meta.items()]
+            if self._active_since: index_rows.append(["", "", "", 0, self._active_since])
+            index = self._index_sheet()
+            # Same as the archives: overwrite in place, then cut the tail, so the listing never goes empty
+            self._call(index.update, values=[INDEX_HEADER] + index_rows, range_name="A1")
+            self._call(index.resize, rows=len(index_rows) + 1)
+            self._archived = None
+            return reclaimed
+
+    # --- CHATSTORE API ---
+    def append_rows(self, rows, retries=None):
+        # retries=0 (the log writer) keeps the guard's backoff sleeps from holding the lock that every read takes
+        with self.lock:
+            for attempt in range(2):
+                resp = self._call(self.ws.append_rows, rows, retries=retries)
+                updated = (resp or {}).get("updates", {}).get("updatedRange", "")
+                if attempt or not updated.strip("'").startswith(ARCHIVE_PREFIX): break
+                # Landed in a log another process archived: take the rows back out and write them to the new log
+                self._call(self.ws.batch_clear, [updated.rsplit("!", 1)[-1]])
+                self._call(self._index_sheet().append_row, ["", updated.rsplit("!", 1)[0].strip("'"), "", 0, ""])
+                self._refresh_active()
+            m = re.search(r"![A-Z]+(\d+)(?::[A-Z]+(\d+))?", updated)
+            if self._index is not None:
+                if not m: self._index = None
+                else:
+                    for offset, row in enumerate(rows):
+                        self._add_row(self._index, row[1], int(m.group(1)) + offset)
+            if m and self._due_for_rotation(int(m.group(2) or m.group(1)) - 1):
+                try: self.rotate()
+                except Exception: self._refresh_active()  # a half-finished rotation is finished by the next one or compact()
+
+    def load_all(self):
+        with self.lock:
+            entries = sorted((e for es in self._load_archived().values() for e in es if e["count"]), key=lambda e: e["row"])
+            rows = []
+            for title in dict.fromkeys(e["worksheet"] for e in entries):
+                rows += [row[:4] for row in self._call(self._archive(title).get_all_values)[1:] if len(row) >= 4 and row[1]]
+            return rows + [row[:4] for row in self._call(self.ws.get_all_values)[1:] if len(row) >= 4 and row[1]]
+
+    @staticmethod
+    def _fingerprint(row):
+        # Timestamp + session + role of a row; cheap to read and unique enough to notice rows shifting
+        return hashlib.md5("\x1f".join((list(row) + [""] * 3)[:3]).encode("utf-8")).hexdigest()
+
+    def read_index(self):
+        # Archived sessions come from the Index worksheet; of the active log only columns A:C are read,
+        # so message bodies never leave the sheet
+        with self.lock:
+            sessions = {}
+            for sid, entries in self._load_archived().items():
+                live = [e for e in entries if e["count"]]
+                if sid and live: sessions[sid] = {"updated": max(e["updated"] for e in live), "count": sum(e["count"] for e in live)}
+            values = self._call(self.ws.get, "A2:C")
+            index = {}
+            for row_num, row in enumerate(values, start=2):
+                ts, sid, _ = (list(row) + [""] * 3)[:3]
+                if not sid: continue
+                self._add_row(index, sid, row_num)
+                meta = sessions.setdefault(sid, {"updated": "", "count": 0})
+                meta["count"] += 1
+                meta["updated"] = max(meta["updated"], ts)
+            self._index = index
+            return sessions, (len(values) + 1, self._fingerprint(values[-1] if values else LOG_HEADER))
+
+    def read_since(self, cursor):
+        # Cursor = (last synced row, fingerprint of that row). If the row moved or changed, rows were deleted/wiped.
+        last_row, fingerprint = cursor
+        with self.lock:
+            values = self._call(self.ws.get, f"A{last_row}:D")
+            if not values or self._fingerprint(values[0]) != fingerprint: return None
+            rows = [(list(r) + [""] * 4)[:4] for r in values[1:]]
+            if any(r[2] == ROTATED_MARKER and not r[1] for r in rows):
+                self._refresh_active()
+                return None
+            if self._index is not None:
+                for offset, row in enumerate(rows):
+                    if row[1]: self._add_row(self._index, row[1], last_row + 1 + offset)
+        return [r for r in rows if r[1]], (last_row + len(rows), self._fingerprint(values[-1]))
+
+    def load_session(self, session_id):
+        with self.lock:
+            rows = [row for _, fetched in self._fetch_archived(session_id, ("A", "D")) for _, row in fetched]
+            # A session that only lives in archives is not looked for in the active log (that would rebuild the index)
+            if not (rows and self._index is not None and session_id not in self._index):
+                _, values = self._fetch_ranges(session_id, ("A", "D"))
+                rows += [row for vr in values for row in vr]
+        return [(row + [""] * 4)[:4] for row in rows]
+
+    def first_user_messages(self, session_ids):
+        # The first row of each session's first range, one batch_get per worksheet. Sessions whose first row
+        # isn't a user message (or whose range moved under us) are left for the caller to load in full
+        with self.lock:
+            archived = self._archived if self._archived is not None else self._load_archived()
+            if self._index is None: self._build_index()
+            wanted = {}
+            for sid in session_ids:
+                live = [e for e in archived.get(sid, []) if e["count"] and e["ranges"]]
+                if live:
+                    first = min(live, key=lambda e: e["row"])
+                    wanted.setdefault(first["worksheet"], []).append((sid, first["ranges"][0][0]))
+                elif self._index.get(sid): wanted.setdefault(None, []).append((sid, self._index[sid][0][0]))
+            out = {}
+            for title, items in wanted.items():
+                ws = self.ws if title is None else self._archive(title)
+                values = self._call(ws.batch_get, [f"A{row}:D{row}" for _, row in items])
+                for (sid, _), vr in zip(items, values):
+                    row = (list(vr[0]) + [""] * 4)[:4] if vr else None
+                    if row and row[1] == sid and row[2] == "user": out[sid] = row[3]
+        return out
+
+    def list_sessions(self):
+        with self.lock: archived = [sid for sid, es in self._load_archived().items() if sid and any(e["count"] for e in es)]
+        return list(dict.fromkeys(archived + [sid for sid in self._call(self.ws.col_values, 2)[1:] if sid]))
+
+    def iter_rows(self, session_ids=None, batch=500):
+        # Filtered: session by session through the indexes. Otherwise every live archive, then the active log,
+        # read in windows of `batch` rows, so an export never holds more than one window
+        if session_ids is not None:
+            for sid in session_ids:
+                rows = self.load_session(sid)
+                for i in range(0, len(rows), batch): yield rows[i:i + batch]
+            return
+        with self.lock:
+            titles = dict.fromkeys(e["worksheet"] for es in self._load_archived().values() for e in sorted(es, key=lambda e: e["row"]) if e["count"])
+            sheets = [self._archive(title) for title in titles] + [self.ws]
+        for ws in sheets:
+            last_row = len(self._call(ws.col_values, 2))
+            for start in range(2, last_row + 1, batch):
+                rows = [(list(r) + [""] * 4)[:4] for r in self._call(ws.get, f"A{start}:D{min(start + batch - 1, last_row)}")]
+                rows = [r for r in rows if r[1]]
+                if rows: yield rows
+
+    def delete_session(self, session_id):
+        with self.lock:
+            # Archives: clear the rows and tombstone the index rows; compact() reclaims the space
+            tombstones = []
+            for entry, fetched in self._fetch_archived(session_id, ("B", "B")):
+                ranges = {}
+                for row_num, _ in fetched: self._add_row(ranges, session_id, row_num)
+                if ranges: self._call(self._archive(entry["worksheet"]).batch_clear, [f"A{s}:D{e}" for s, e in ranges[session_id]])
+                tombstones.append({"range": f"A{entry['row']}:E{entry['row']}", "values": [[session_id, entry["worksheet"], "", 0, entry["updated"]]]})
+            self._archived.pop(session_id, None)
+            if tombstones: self._call(self._index_sheet().batch_update, tombstones)
+            # Active log: one batchUpdate of deleteDimension requests: atomic, and there is never a cleared sheet
+            ranges, _ = self._fetch_ranges(session_id, ("B", "B"))
+            if ranges:
+                requests = [{"deleteDimension": {"range": {"sheetId": self.ws.id, "dimension": "ROWS", "startIndex": start - 1, "endIndex": end}}}
+                            for start, end in sorted(ranges, reverse=True)]
+                self._call(self.ws.spreadsheet.batch_update, {"requests": requests})
+                self._forget_ranges(session_id, ranges)
+            # Drop the stored title too, so a reused session ID never shows a stale title
+            if self._title_rows is None: self.load_titles()
+            row_num = self._title_rows.pop(session_id, None)
+            if row_num: self._call(self._titles_ws().batch_clear, [f"A{row_num}:C{row_num}"])
+
+    def wipe(self):
+        with self.lock:
+            self._refresh_active()
+            for ws in self._call(self.ws.spreadsheet.worksheets):
+                if ws.title.startswith(ARCHIVE_PREFIX): self._call(self.ws.spreadsheet.del_worksheet, ws)
+            self._call(self.ws.clear)
+            self._call(self.ws.append_row, LOG_HEADER)
+            index = self._index_sheet()
+            self._call(index.clear)
+            self._call(index.append_row, INDEX_HEADER)
+            self._index, self._archived, self._archive_ws = {}, {}, {}
+            self._mark_started()
+            titles = self._titles_ws()
+            self._call(titles.clear)
+            self._call(titles.append_row, TITLES_HEADER)
+            self._title_rows = {}
+
+    # --- TITLES WORKSHEET ---
+    def _titles_ws(self):
+        if self._titles is None: self._titles = self._worksheet("Titles", TITLES_HEADER)
+        return self._titles
+
+    def load_titles(self):
+        with self.lock:
+            rows = self._call(self._titles_ws().get_all_values)[1:]
+            self._title_rows = {row[0]: row_num for row_num, row in enumerate(rows, start=2) if row and row[0]}
+        return {row[0]: (row[1], row[2]) for row in rows if len(row) >= 3 and row[0]}
+
+    def save_titles(self, entries):
+        with self.lock:
+            ws = self._titles_ws()
+            if self._title_rows is None: self.load_titles()
+            updates, new_rows = [], []
+            for sid, msg_hash, title in entries:
+                row_num = self._title_rows.get(sid)
+                if row_num: updates.append({"range": f"A{row_num}:C{row_num}", "values": [[sid, msg_hash, title]]})
+                else: new_rows.append([sid, msg_hash, title])
+            if updates: self._call(ws.batch_update, updates)
+            if new_rows:
+                self._call(ws.append_rows, new_rows)
+                self._title_rows = None  # row numbers of the new rows are picked up on the next load
+
+
+class SQLiteStore(ChatStore):
+    """Local SQLite log, indexed by session and timestamp. Good for offline runs and tests."""
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.executescript("""
+                CREATE TABLE IF NOT EXISTS messages (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    ts TEXT NOT NULL,
+                    session_id TEXT NOT NULL,
+                    role TEXT NOT NULL,
+                    content TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_messages_session ON messages(session_id, id);
+                CREATE INDEX IF NOT EXISTS idx_messages_ts ON messages(ts);
+                CREATE TABLE IF NOT EXISTS titles (session_id TEXT PRIMARY KEY, msg_hash TEXT NOT NULL, title TEXT NOT NULL);
+                CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL);
+                INSERT OR IGNORE INTO meta (key, value) VALUES ('generation', 0);
+            """)
+
+    def _query(self, sql, args=()):
+        with self.lock:
+            return [list(row) for row in self.conn.execute(sql, args).fetchall()]
+
+    def append_rows(self, rows, retries=None):
+        with self.lock, self.conn:
+            self.conn.executemany("INSERT INTO messages (ts, session_id, role, content) VALUES (?, ?, ?, ?)", [row[:4] for row in rows])
+
+    def load_all(self):
+        return self._query("SELECT ts, session_id, role, content FROM messages ORDER BY id")
+
+    def read_index(self):
+        with self.lock:
+            generation = self.conn.execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()[0]
+            last_id = self.conn.execute("SELECT COALESCE(MAX(id), 0) FROM messages").fetchone()[0]
+            rows = self.conn.execute("SELECT session_id, MAX(ts), COUNT(*) FROM messages GROUP BY session_id ORDER BY MIN(id)").fetchall()
+        return {sid: {"updated": ts, "count": n} for sid, ts, n in rows}, (last_id, generation)
+
+    def read_since(self, cursor):
+        # Cursor = (last message id, generation). Deletes and wipes bump the generation.
+        last_id, generation = cursor
+        with self.lock:
+            if self.conn.execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()[0] != generation: return None
+            rows = self.conn.execute("SELECT id, ts, session_id, role, content FROM messages WHERE id > ? ORDER BY id", (last_id,)).fetchall()
+        if rows: last_id = rows[-1][0]
+        return [list(row[1:]) for row in rows], (last_id, generation)
+
+    def _bump_generation(self):
+        self.conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'generation'")
+
+    def load_session(self, session_id):
+        return self._query("SELECT ts, session_id, role, content FROM messages WHERE session_id = ? ORDER BY id", (session_id,))
+
+    def list_sessions(self):
+        return [row[0] for row in self._query("SELECT session_id FROM messages GROUP BY session_id ORDER BY MIN(id)")]
+
+    def first_user_messages(self, session_ids):
+        out = {}
+        for i in range(0, len(session_ids), 500):  # stay under SQLite's bound-parameter limit
+            part = list(session_ids[i:i + 500])
+            out.update(self._query(f"SELECT session_id, content FROM messages WHERE id IN (SELECT MIN(id) FROM messages WHERE role = 'user' "
+                                   f"AND session_id IN ({', '.join('?' * len(part))}) GROUP BY session_id)", part))
+        return out
+
+    def delete_session(self, session_id):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+            self.conn.execute("DELETE FROM titles WHERE session_id = ?", (session_id,))
+            self._bump_generation()
+
+    def wipe(self):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM messages")
+            self.conn.execute("DELETE FROM titles")
+            self._bump_generation()
+
+    def compact(self):
+        with self.lock: self.conn.execute("VACUUM")
+        return 0
+
+    def iter_rows(self, session_ids=None, batch=500):
+        # Keyset pagination: one short query per batch, so the log is never loaded whole and writers aren't held up
+        if session_ids is not None and not session_ids: return
+        where = f" AND session_id IN ({', '.join('?' * len(session_ids))})" if session_ids is not None else ""
+        last_id = 0
+        while True:
+            with self.lock:
+                rows = self.conn.execute(f"SELECT id, ts, session_id, role, content FROM messages WHERE id > ?{where} ORDER BY id LIMIT ?",
+                                         [last_id] + list(session_ids or []) + [batch]).fetchall()
+            if not rows: return
+            last_id = rows[-1][0]
+            yield [list(row[1:]) for row in rows]
+
+    def load_titles(self):
+        return {sid: (msg_hash, title) for sid, msg_hash, title in self._query("SELECT session_id, msg_hash, title FROM titles")}
+
+    def save_titles(self, entries):
+        with self.lock, self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO titles (session_id, msg_hash, title) VALUES (?, ?, ?)", list(entries))
+
@@ -0,0 +1,128 @@
+"""Structured client briefs parsed from clients.csv.
+
+clients.csv is a transposed sheet: column A is the section (carried down), column B the variable and every
+further column one client. The app loads it once per file change and injects only the brief of the client a
+prompt is about, instead of attaching the whole CSV to every turn.
+"""
+import csv
+import hashlib
+import io
+import re
+
+DEFAULT_PATH = "clients.csv"
+NAME_SCORE = 10      # an explicit client name always wins over keyword overlap
+MIN_KEYWORD_TERMS = 2  # without the name, a client needs this many distinct keywords from its brief
+
+_TOKEN = re.compile(r"[a-z0-9]+")
+_PAREN = re.compile(r"\(([^)]*)\)")
+_STOPWORDS = set("""a an and are as at be but by for from has have in is it its of on or our so that the their this to
+with your client clients depending positioning independent drink drinks beverage beverages""".split())
+
+
+def _tokens(text):
+    return {t for t in _TOKEN.findall(text.lower()) if t not in _STOPWORDS and len(t) > 2}
+
+
+def repair_csv_text(text, ncols):
+    """Closes quoted cells the sheet export left open.
+
+    A spreadsheet row that is nothing but commas can never sit inside a cell, so if one shows up while a quote is
+    still open, the quote belonged at the end of the previous line.
+    """
+    lines, in_quote = text.split("\n"), False
+    blank_row = re.compile(r"^,{%d,}\r?$" % max(ncols - 1, 1))
+    for i, line in enumerate(lines):
+        if in_quote and blank_row.match(line) and i:
+            lines[i - 1] = lines[i - 1].rstrip("\r") + '"'
+            in_quote = False
+        if line.count('"') % 2: in_quote = not in_quote
+    return "\n".join(lines)
+
+
+def _compact(value):
+    return "; ".join(line.strip(" -•\t") for line in value.splitlines() if line.strip(" -•\t"))
+
+
+class ClientBriefs:
+    """{client: [(section, variable, value)]}, plus a (client, variable) lookup table and match keywords."""
+
+    def __init__(self, clients, rows, version=""):
+        self.clients = clients
+        self.rows = rows
+        self.version = version
+        self.table = {(client, variable.lower()): value for client, items in rows.items() for _, variable, value in items}
+        self.aliases, self.keywords = {}, {}
+        for client in clients:
+            name = _PAREN.sub("", client).strip().lower()
+            described = " ".join(_PAREN.findall(client))
+            # The parenthetical is a description ("Bar", "Restaurant"), not a name: it only counts as keywords
+            self.aliases[client] = {a for a in (client.lower(), name) if len(a) >= 4}
+            weights = {t: 1 for v in ("concept", "business type") for t in _tokens(self.get(client, v) or "")}
+            weights.update({t: 2 for t in _tokens(described)})
+            self.keywords[client] = weights
+
+    @classmethod
+    def parse(cls, text):
+        text = text.lstrip("\ufeff")
+        header = next(csv.reader(io.StringIO(text.split("\n", 1)[0])), [])
+        ncols = len(header)
+        if ncols < 3: raise ValueError("expected section, variable and at least one client column")
+        clients = [h.strip() or f"Client {i - 1}" for i, h in enumerate(header[2:], start=2)]
+        rows, section = {c: [] for c in clients}, ""
+        reader = csv.reader(io.StringIO(repair_csv_text(text, ncols)))
+        next(reader, None)
+        for row in reader:
+            if len(row) > ncols: row = row[:ncols - 1] + [",".join(row[ncols - 1:])]
+            row += [""] * (ncols - len(row))
+            section = row[0].strip() or section
+            variable = row[1].strip() or section
+            if not variable: continue
+            for client, value in zip(clients, row[2:]):
+                value = value.strip()
+                if value: rows[client].append((section, variable, value))
+        version = hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+        return cls(clients, {c: items for c, items in rows.items() if items}, version)
+
+    @classmethod
+    def load(cls, path=DEFAULT_PATH):
+        with open(path, encoding="utf-8", errors="replace", newline="") as f: return cls.parse(f.read())
+
+    def get(self, client, variable):
+        return self.table.get((client, variable.lower()))
+
+    def match(self, text):
+        """(client, named): the client a piece of text is about, or (None, False).
+
+        A client qualifies by name or by MIN_KEYWORD_TERMS distinct keywords; names beat keywords and ties match
+        nobody. One generic word ("cafe", "bar") is not enough to inject somebody's brief. `named` is False when
+        only keywords matched: the text may be about a similar business rather than this client.
+        """
+        lowered, tokens = text.lower(), _tokens(text)
+        scores, named = {}, set()
+        for client in self.rows:
+            hits = [t for t in self.keywords[client] if t in tokens]
+            if any(re.search(rf"\b{re.escape(a)}\b", lowered) for a in self.aliases[client]): named.add(client)
+            elif len(hits) < MIN_KEYWORD_TERMS: continue
+            scores[client] = sum(self.keywords[client][t] for t in hits) + (NAME_SCORE if client in named else 0)
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+        if not ranked: return None, False
+        if len(ranked) > 1 and ranked[1][1] == ranked[0][1]: return None, False
+        return ranked[0][0], ranked[0][0] in named
+
+    def brief_for(self, prompt, history_msgs=()):
+        """(client, brief_text, named) for the prompt, else for the latest earlier user turn that matches a client."""
+        candidates = [prompt] + [m["content"] for m in reversed(history_msgs) if m["role"] == "user" and m["content"] != prompt]
+        for text in candidates:
+            client, named = self.match(text)
+            if client: return client, self.format(client), named
+        return None, None, False
+
+    def format(self, client):
+        lines, section = [f"Client brief: {client}"], None
+        for sec, variable, value in self.rows.get(client, []):
+            if sec != section:
+                lines.append(f"[{sec}]")
+                section = sec
+            lines.append(f"- {variable}: {_compact(value)}")
+        return "\n".join(lines)
+
@@ -0,0 +1,88 @@
+"""Server-side context cache for the system prompt and knowledge base.
+
+With CONTEXT_CACHE = true in secrets, the app caches the system prompt and KB files once per (model, prompt,
+KB version) as a Gemini CachedContent, so each turn only sends the conversation. Any failure falls back to the
+uncached request. `client` is the google.generativeai module, or a stand-in with the same surface
+(caching.CachedContent.list/create, GenerativeModel.from_cached_content) for tests and benchmark.py.
+"""
+import hashlib
+import threading
+from datetime import datetime, timedelta, timezone
+
+KB_CONTEXT_NOTE = "System Context: Reference materials attached. Use them."
+DISPLAY_PREFIX = "json3-"
+
+
+class ContextCache:
+    def __init__(self, client, model_name, ttl=3600, refresh_margin=300, guard=None):
+        self.client = client
+        self.model_name = model_name
+        self.ttl = ttl
+        self.refresh_margin = refresh_margin
+        self.guard = guard
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "creates": 0, "refreshes": 0, "failures": 0, "last_error": None}
+        self.disabled = False
+        self._key = None
+        self._cached = None
+        self._model = None
+
+    def _call(self, fn, *args, **kwargs):
+        return self.guard.call("gemini", fn, *args, **kwargs) if self.guard else fn(*args, **kwargs)
+
+    @staticmethod
+    def cache_key(model_name, system_prompt, kb_version):
+        return hashlib.sha256("\x1f".join([model_name, system_prompt, kb_version]).encode("utf-8")).hexdigest()[:32]
+
+    @staticmethod
+    def expires_in(cached):
+        expire_time = getattr(cached, "expire_time", None)
+        if not expire_time: return 0
+        if expire_time.tzinfo is None: expire_time = expire_time.replace(tzinfo=timezone.utc)
+        return (expire_time - datetime.now(timezone.utc)).total_seconds()
+
+    def _find(self, display_name):
+        # Another worker process may already have built this cache
+        for cached in self._call(lambda: list(self.client.caching.CachedContent.list())):
+            if getattr(cached, "display_name", None) == display_name and self.expires_in(cached) > self.refresh_margin: return cached
+        return None
+
+    def _create(self, display_name, system_prompt, kb_files):
+        self.stats["creates"] += 1
+        return self._call(
+            self.client.caching.CachedContent.create,
+            model=self.model_name,
+            display_name=display_name,
+            system_instruction=system_prompt,
+            contents=[{"role": "user", "parts": list(kb_files) + [KB_CONTEXT_NOTE]}, {"role": "model", "parts": ["Acknowledged."]}],
+            ttl=timedelta(seconds=self.ttl),
+        )
+
+    def model_for(self, system_prompt, kb_files, kb_version):
+        """GenerativeModel bound to the cached context, or None to use the uncached request."""
+        if self.disabled or not kb_files: return None
+        key = self.cache_key(self.model_name, system_prompt, kb_version)
+        with self.lock:
+            try:
+                if self._key == key and self._cached is not None:
+                    if self.expires_in(self._cached) <= self.refresh_margin:
+                        self._call(self._cached.update, ttl=timedelta(seconds=self.ttl))
+                        self.stats["refreshes"] += 1
+                    self.stats["hits"] += 1
+                    return self._model
+                display_name = f"{DISPLAY_PREFIX}{key}"
+                cached = self._find(display_name) or self._create(display_name, system_prompt, kb_files)
+                if self._cached is not None:
+                    try: self._call(self._cached.delete)  # prompt or KB changed: the old cache is dead weight
+                    except Exception: pass
+                self._key, self._cached = key, cached
+                self._model = self.client.GenerativeModel.from_cached_content(cached_content=cached)
+                return self._model
+            except Exception as e:
+                self.stats["failures"] += 1
+                self.stats["last_error"] = f"{type(e).__name__}: {e}"
+                self._key = self._cached = self._model = None
+                # 400/403/404: model or content not cacheable (e.g. below the minimum token count); stop trying
+                if getattr(e, "code", None) in (400, 403, 404): self.disabled = True
+                return None
+
@@ -0,0 +1,208 @@
+"""Offline retrieval index over the knowledge base (BM25, pure Python).
+
+Build it once whenever the KB files change:
+
+    python kb_index.py build                       # bible1.pdf bible2.pdf studies.pdf
+    python kb_index.py query "pandan milk tea for Tealive" -k 5
+    python kb_index.py eval queries.jsonl -k 5      # {"query": ..., "expect": "text or file name"} per line
+
+The app (KB_MODE = "retrieval") loads kb_index.json and attaches only the top passages to each turn.
+"""
+import argparse
+import csv
+import hashlib
+import json
+import math
+import os
+import re
+import sys
+import time
+from collections import Counter
+
+DEFAULT_SOURCES = ["bible1.pdf", "bible2.pdf", "studies.pdf"]  # clients.csv is served as structured briefs
+DEFAULT_INDEX = "kb_index.json"
+CHUNK_CHARS = 1200
+CHUNK_OVERLAP = 200
+INDEX_VERSION = 1
+
+_TOKEN = re.compile(r"[a-z0-9]+")
+_STOPWORDS = set("""a an and are as at be but by for from has have i in is it its me my of on or our so that the their them
+these they this to was we were what when which will with you your can do does how kindly please give like want""".split())
+
+
+def tokenize(text):
+    return [t for t in _TOKEN.findall(text.lower()) if t not in _STOPWORDS and len(t) > 1]
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""): digest.update(block)
+    return digest.hexdigest()
+
+
+# --- EXTRACTION ---
+def extract_pages(path):
+    """Yields (page_number, text). PDFs need pypdf; CSV rows become "column: value" lines."""
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".pdf":
+        try: from pypdf import PdfReader
+        except ImportError: raise ImportError("pypdf is required to index PDFs: pip install pypdf") from None
+        for page_num, page in enumerate(PdfReader(path).pages, start=1):
+            yield page_num, page.extract_text() or ""
+    elif ext == ".csv":
+        with open(path, newline="", encoding="utf-8") as f:
+            rows = list(csv.reader(f))
+        header = rows[0] if rows else []
+        for row_num, row in enumerate(rows[1:], start=2):
+            cells = [f"{(header[i] if i < len(header) else '').strip() or 'Field'}: {cell.strip()}" for i, cell in enumerate(row) if cell.strip()]
+            if cells: yield row_num, "\n".join(cells)
+    else:
+        with open(path, encoding="utf-8", errors="replace") as f:
+            yield 1, f.read()
+
+
+def chunk_text(text, size=CHUNK_CHARS, overlap=CHUNK_OVERLAP):
+    text = re.sub(r"[ \t]+", " ", text).strip()
+    if len(text) <= size:
+        if text: yield text
+        return
+    start = 0
+    while start < len(text):
+        end = min(start + size, len(text))
+        if end < len(text):
+            # Prefer to cut at a paragraph or sentence boundary inside the window
+            cut = max(text.rfind("\n\n", start, end), text.rfind(". ", start, end))
+            if cut > start + size // 2: end = cut + 1
+        yield text[start:end].strip()
+        if end >= len(text): break
+        start = max(end - overlap, start + 1)
+
+
+# --- INDEX ---
+class KBIndex:
+    """BM25 over KB chunks. Postings are {term: [[chunk_id, tf], ...]}."""
+    k1, b = 1.5, 0.75
+
+    def __init__(self, data):
+        self.sources = data["sources"]
+        self.chunks = data["chunks"]
+        self.postings = data["postings"]
+        self.lengths = data["lengths"]
+        self.avgdl = data["avgdl"] or 1.0
+        self.built_at = data.get("built_at")
+        n = len(self.chunks)
+        self.idf = {t: math.log(1 + (n - len(p) + 0.5) / (len(p) + 0.5)) for t, p in self.postings.items()}
+        self.stats = {"queries": 0, "total_ms": 0.0}
+
+    @classmethod
+    def build(cls, paths):
+        chunks, postings, lengths, sources = [], {}, [], {}
+        for path in paths:
+            if not os.path.exists(path): continue
+            sources[os.path.basename(path)] = file_sha256(path)
+            for page, text in extract_pages(path):
+                for piece in chunk_text(text):
+                    terms = Counter(tokenize(piece))
+                    if not terms: continue
+                    chunk_id = len(chunks)
+                    chunks.append({"source": os.path.basename(path), "page": page, "text": piece})
+                    lengths.append(sum(terms.values()))
+                    for term, tf in terms.items(): postings.setdefault(term, []).append([chunk_id, tf])
+        return cls({"version": INDEX_VERSION, "built_at": time.time(), "sources": sources, "chunks": chunks,
+                    "postings": postings, "lengths": lengths, "avgdl": (sum(lengths) / len(lengths)) if lengths else 1.0})
+
+    def save(self, path=DEFAULT_INDEX):
+        data = {"version": INDEX_VERSION, "built_at": self.built_at, "sources": self.sources, "chunks": self.chunks,
+                "postings": self.postings, "lengths": self.lengths, "avgdl": self.avgdl}
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f: json.dump(data, f)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path=DEFAULT_INDEX):
+        with open(path, encoding="utf-8") as f: data = json.load(f)
+        if data.get("version") != INDEX_VERSION: raise ValueError(f"{path} is index version {data.get('version')}, expected {INDEX_VERSION}")
+        return cls(data)
+
+    def stale_sources(self, paths):
+        """Files whose content no longer matches what was indexed (or that were never indexed)."""
+        return [p for p in paths if os.path.exists(p) and self.sources.get(os.path.basename(p)) != file_sha256(p)]
+
+    def search(self, query, k=5):
+        """Returns [(score, chunk)] best first."""
+        started = time.perf_counter()
+        scores = {}
+        for term in set(tokenize(query)):
+            idf = self.idf.get(term)
+            if idf is None: continue
+            for chunk_id, tf in self.postings[term]:
+                norm = tf + self.k1 * (1 - self.b + self.b * self.lengths[chunk_id] / self.avgdl)
+                scores[chunk_id] = scores.get(chunk_id, 0.0) + idf * tf * (self.k1 + 1) / norm
+        best = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+        self.stats["queries"] += 1
+        self.stats["total_ms"] += (time.perf_counter() - started) * 1000
+        return [(score, self.chunks[chunk_id]) for chunk_id, score in best]
+
+
+def format_passages(hits):
+    return "\n\n".join(f"[{i}] ({c['source']}, p.{c['page']})\n{c['text']}" for i, (_, c) in enumerate(hits, start=1))
+
+
+# --- CLI ---
+def _evaluate(index, path, k):
+    """hit@k and MRR: a hit is a passage whose source or text contains the expected string."""
+    hits, rr, total, latencies = 0, 0.0, 0, []
+    with open(path, encoding="utf-8") as f:
+        cases = [json.loads(line) for line in f if line.strip()]
+    for case in cases:
+        started = time.perf_counter()
+        results = index.search(case["query"], k)
+        latencies.append((time.perf_counter() - started) * 1000)
+        expect = case["expect"].lower()
+        rank = next((i for i, (_, c) in enumerate(results, start=1) if expect in c["source"].lower() or expect in c["text"].lower()), None)
+        total += 1
+        if rank:
+            hits += 1
+            rr += 1 / rank
+    latencies.sort()
+    p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] if latencies else 0.0
+    print(f"cases={total} hit@{k}={hits / max(total, 1):.3f} mrr={rr / max(total, 1):.3f} "
+          f"latency_ms p50={latencies[len(latencies) // 2] if latencies else 0.0:.2f} p95={p95:.2f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--index", default=DEFAULT_INDEX)
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p_build = sub.add_parser("build", help="extract, chunk and index the KB files")
+    p_build.add_argument("paths", nargs="*", default=DEFAULT_SOURCES)
+    p_query = sub.add_parser("query", help="show the top passages for a prompt")
+    p_query.add_argument("text")
+    p_query.add_argument("-k", type=int, default=5)
+    p_eval = sub.add_parser("eval", help="hit@k / MRR / latency over a JSONL query set")
+    p_eval.add_argument("cases")
+    p_eval.add_argument("-k", type=int, default=5)
+    args = parser.parse_args(argv)
+
+    if args.cmd == "build":
+        started = time.perf_counter()
+        try: index = KBIndex.build(args.paths)
+        except ImportError as e:
+            print(f"error: {e}", file=sys.stderr)
+            return 1
+        index.save(args.index)
+        print(f"indexed {len(index.chunks)} chunks from {len(index.sources)} files in {time.perf_counter() - started:.1f}s -> {args.index}")
+        return 0
+    index = KBIndex.load(args.index)
+    if args.cmd == "query":
+        hits = index.search(args.text, args.k)
+        for score, c in hits: print(f"{score:7.3f}  {c['source']} p.{c['page']}: {c['text'][:120]!r}")
+        print(f"({index.stats['total_ms']:.2f} ms)")
+    else:
+        _evaluate(index, args.cases, args.k)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())